@@ -88,10 +88,12 @@ def parse_args():
     parser.error = parser_error
     parser._optionals.title = "OPTIONS"
     parser.add_argument('-d', '--domain', help="Domain name to enumerate it's subdomains", required=True)
-    parser.add_argument('-b', '--bruteforce', help='Enable the subbrute bruteforce module', nargs='?', default=False)
+    parser.add_argument('-b', '--bruteforce', help='Enable the subbrute bruteforce module, optionally choosing its engine (process, async, blast)', nargs='?', default=False)
     parser.add_argument('-p', '--ports', help='Scan the found subdomains against specified tcp ports')
     parser.add_argument('-v', '--verbose', help='Enable Verbosity and display results in realtime', nargs='?', default=False)
-    parser.add_argument('-t', '--threads', help='Number of threads to use for subbrute bruteforce', type=int, default=30)
+    parser.add_argument('-t', '--threads', help='Number of threads to use for subbrute bruteforce (process engine)', type=int, default=30)
+    parser.add_argument('-c', '--concurrency', help='Number of DNS queries in flight for subbrute bruteforce (async and blast engines)', type=int, default=1000)
+    parser.add_argument('-m', '--permute', help='With -b, first try permutations of the found subdomains (api2 -> api3, api -> api-dev, dev.api)', default=False, action='store_true')
     parser.add_argument('-e', '--engines', help='Specify a comma-separated list of search engines')
     parser.add_argument('-o', '--output', help='Save the results to text file')
     parser.add_argument('-n', '--no-color', help='Output without color', default=False, action='store_true')
@@ -854,7 +856,7 @@ class portscan():
             t = threading.Thread(target=self.port_scan, args=(subdomain, self.ports))
             t.start()
 
-def main(domain, threads, savefile, ports, silent, verbose, enable_bruteforce, engines):
+def main(domain, threads, savefile, ports, silent, verbose, enable_bruteforce, engines, concurrency=1000, permute=False):
     bruteforce_list = set()
     search_list = set()
     if is_windows:
@@ -862,6 +864,9 @@ def main(domain, threads, savefile, ports, silent, verbose, enable_bruteforce, e
     else:
         subdomains_queue = multiprocessing.Manager().list()
     # Check Bruteforce Status
+    bruteforce_engine = 'process'
+    if enable_bruteforce in subbrute.engines:
+        bruteforce_engine = enable_bruteforce
     if enable_bruteforce or enable_bruteforce is None:
         enable_bruteforce = True
     # Validate domain
@@ -918,9 +923,11 @@ def main(domain, threads, savefile, ports, silent, verbose, enable_bruteforce, e
         subs = os.path.join(path_to_file, 'subbrute', 'names.txt')
         resolvers = os.path.join(path_to_file, 'subbrute', 'resolvers.txt')
         process_count = threads
-        output = False
-        json_output = False
-        bruteforce_list = subbrute.print_target(parsed_domain.netloc, record_type, subs, resolvers, process_count, output, json_output, search_list, verbose)
+        # Results stream in as they are confirmed
+        for (hostname, result_type, response) in subbrute.stream_target(parsed_domain.netloc, record_type, subs, resolvers, process_count, search_list, engine=bruteforce_engine, concurrency=concurrency, permute=permute):
+            if verbose:
+                print(hostname)
+            bruteforce_list.add(hostname)
     subdomains = search_list.union(bruteforce_list)
     if subdomains:
         subdomains = sorted(subdomains, key=subdomain_sorting_key)
@@ -948,12 +955,14 @@ def interactive():
     enable_bruteforce = args.bruteforce
     verbose = args.verbose
     engines = args.engines
+    concurrency = args.concurrency
+    permute = args.permute
     if verbose or verbose is None:
         verbose = True
     if args.no_color:
         no_color()
     banner()
-    res = main(domain, threads, savefile, ports, silent=False, verbose=verbose, enable_bruteforce=enable_bruteforce, engines=engines)
+    res = main(domain, threads, savefile, ports, silent=False, verbose=verbose, enable_bruteforce=enable_bruteforce, engines=engines, concurrency=concurrency, permute=permute)
 
 if __name__ == "__main__":
     interactive()
\ No newline at end of file
@@ -15,10 +15,34 @@ import sys
 import uuid
 import random
 import ctypes
+import socket
+import time
+import collections
+import itertools
+import array
+import heapq
+import struct
+import select
+import mmap
+import gzip
+import hashlib
+import math
+import threading
 import dns.resolver
 import dns.rdatatype
+import dns.rdataclass
+import dns.message
+import dns.rcode
+import dns.flags
+import dns.query
 import json
 
+#The answer cache is optional,  some Python builds leave out sqlite3.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 #Python 2.x and 3.x compatiablity
 #We need the Queue library for exception handling
 try:
@@ -26,18 +50,128 @@ try:
 except:
     import Queue
 
+#The async engine needs an event loop, Python 2.x can still use the 'process' engine.
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 #The 'multiprocessing' library does not rely upon a Global Interpreter Lock (GIL)
 import multiprocessing
 
 #Microsoft compatiablity
 if  sys.platform.startswith('win'):
     #Drop-in replacement,  subbrute + multiprocessing throws exceptions on windows.
-    import threading
     multiprocessing.Process = threading.Thread
 
+#Resolver health survives between runs,  so vetting is only paid once per TTL window.
+#Set resolver_cache_file to "" to disable the cache.
+resolver_cache_file = os.path.join(os.path.expanduser("~"), ".subbrute", "resolver_cache.json")
+resolver_cache_ttl = 3600
+#How many recently healthy resolvers are vetted again to find the target's wildcards.
+resolver_spot_checks = 4
+
+def load_resolver_cache():
+    if not resolver_cache_file:
+        return {}
+    try:
+        with open(resolver_cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+#Merge new health records into the cache,  another run may have written it meanwhile.
+def save_resolver_cache(health):
+    if not resolver_cache_file or not health:
+        return
+    cache = load_resolver_cache()
+    cache.update(health)
+    try:
+        cache_dir = os.path.dirname(resolver_cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp_file = "%s.%d" % (resolver_cache_file, os.getpid())
+        with open(temp_file, "w") as f:
+            json.dump(cache, f)
+        #Readers never see a half written file.
+        getattr(os, "replace", os.rename)(temp_file, resolver_cache_file)
+    except (IOError, OSError) as e:
+        trace("Failed writing resolver cache:", resolver_cache_file, e)
+
+#A negative answer without an SOA record,  or from an old dnspython,  is remembered this long.
+negative_cache_ttl = 3600
+
+#Answers and NXDOMAINs survive between runs,  a repeat scan only asks about names whose TTL ran out.
+#Rows are keyed by (name, record_type),  addresses is None for a negative answer and
+#hosts are the spidered hosts the answer pointed at,  so a cached answer spiders the same way.
+#The parent process is the only writer,  writes are batched into one transaction.
+#The lookup processes open their own connection and only read,  WAL lets them do so while the parent writes.
+class answer_cache(object):
+    def __init__(self, file_name, batch_size = 512):
+        if sqlite3 is None:
+            error("The answer cache requires the sqlite3 module.")
+        self.file_name = file_name
+        self.batch_size = batch_size
+        cache_dir = os.path.dirname(file_name)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.db = sqlite3.connect(file_name, timeout = 30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS answers (name TEXT, type TEXT, addresses TEXT, hosts TEXT, expires REAL, PRIMARY KEY (name, type))")
+        self.db.commit()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    #Returns (addresses, hosts) for a fresh answer,  None if the network has to be asked.
+    def get(self, name, record_type):
+        row = self.db.execute("SELECT addresses, hosts, expires FROM answers WHERE name = ? AND type = ?", (name.lower(), record_type or "A")).fetchone()
+        if not row or row[2] < time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        addresses = json.loads(row[0]) if row[0] is not None else None
+        return (addresses, json.loads(row[1]))
+
+    def put(self, name, record_type, addresses, hosts, ttl):
+        if not ttl or ttl <= 0:
+            return
+        self.pending.append((name.lower(), record_type or "A", json.dumps(addresses) if addresses is not None else None, json.dumps(hosts or []), time.time() + ttl))
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.db.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)", self.pending)
+            self.db.commit()
+            self.pending = []
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+#How long a negative answer may be cached,  the lesser of the SOA's TTL and its minimum (RFC 2308).
+#e is the NXDOMAIN or NoAnswer exception,  or the reply itself.
+def negative_ttl(e):
+    try:
+        if isinstance(e, dns.message.Message):
+            responses = [e]
+        elif isinstance(e, dns.resolver.NXDOMAIN):
+            responses = list(e.responses().values())
+        else:
+            responses = [e.kwargs.get("response")]
+    except Exception:
+        #dnspython 1.x doesn't hand over the reply.
+        return negative_cache_ttl
+    for response in responses:
+        for rrset in getattr(response, "authority", []):
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return negative_cache_ttl
+
 class verify_nameservers(multiprocessing.Process):
 
-    def __init__(self, target, record_type, resolver_q, resolver_list, wildcards):
+    def __init__(self, target, record_type, resolver_q, resolver_list, wildcards, verify_threads = 32):
         multiprocessing.Process.__init__(self, target = self.run)
         self.daemon = True
         signal_init()
@@ -51,7 +185,8 @@ class verify_nameservers(multiprocessing.Process):
         if record_type == "AAAA":
             self.record_type = record_type
         self.resolver_list = resolver_list
-        resolver = dns.resolver.Resolver()
+        #How many resolvers are vetted at the same time.
+        self.verify_threads = verify_threads
         #The domain provided by the user.
         self.target = target
         #1 website in the world,  modify the following line when this status changes.
@@ -59,62 +194,146 @@ class verify_nameservers(multiprocessing.Process):
         self.most_popular_website = "www.google.com"
         #We shouldn't need the backup_resolver, but we we can use them if need be.
         #We must have a resolver,  and localhost can work in some environments.
-        self.backup_resolver = resolver.nameservers + ['127.0.0.1', '8.8.8.8', '8.8.4.4']
+        self.backup_resolver = dns.resolver.Resolver().nameservers + ['127.0.0.1', '8.8.8.8', '8.8.4.4']
         #Ideally a nameserver should respond in less than 1 sec.
-        resolver.timeout = 1
-        resolver.lifetime = 1
-        try:
-            #Lets test the letancy of our connection.
-            #Google's DNS server should be an ideal time test.
-            resolver.nameservers = ['8.8.8.8']
-            resolver.query(self.most_popular_website, self.record_type)
-        except:
-            #Our connection is slower than a junebug in molasses
-            resolver = dns.resolver.Resolver()
-        self.resolver = resolver
+        self.timeout = 1
+        #Vetted resolvers waiting to be handed out, a heap of (score, nameserver).
+        self.verified = []
+        self.verified_lock = threading.Lock()
+        #How many resolvers passed in this run.
+        self.passed = 0
+        #What we learned about each resolver,  saved to the resolver cache.
+        self.health = {}
 
     def end(self):
         self.time_to_die = True
 
     #This process cannot block forever,  it  needs to check if its time to die.
+    #The wildcards found so far travel with the nameserver,  so lookups can check them locally.
     def add_nameserver(self, nameserver):
+        with self.verified_lock:
+            wildcards = list(self.wildcards)
         keep_trying = True
         while not self.time_to_die and keep_trying:
             try:
-                self.resolver_q.put(nameserver, timeout = 1)
+                self.resolver_q.put((nameserver, wildcards), timeout = 1)
                 trace("Added nameserver:", nameserver)
                 keep_trying = False
             except Exception as e:
                 if type(e) == Queue.Full or str(type(e)) == "<class 'queue.Full'>":
                     keep_trying = True
 
+    #Resolvers are vetted concurrently,  the fastest healthy ones are handed out first.
+    #Resolvers that failed within the cache TTL are skipped,  and the ones that passed
+    #are only spot-checked: wildcards are per target, resolver health is not.
     def verify(self, nameserver_list):
-        added_resolver = False
+        now = time.time()
+        cache = load_resolver_cache()
+        cached = []
+        servers = Queue.Queue()
         for server in nameserver_list:
-            if self.time_to_die:
-                #We are done here.
-                break
             server = server.strip()
-            if server:
-                self.resolver.nameservers = [server]
-                try:
-                    #test_result = self.resolver.query(self.most_popular_website, "A")
-                    #should throw an exception before this line.
-                    if True:#test_result:
-                        #Only add the nameserver to the queue if we can detect wildcards. 
-                        if(self.find_wildcards(self.target)):# and self.find_wildcards(".com")
-                            #wildcards have been added to the set, it is now safe to be added to the queue.
-                            #blocking queue,  this process will halt on put() when the queue is full:
-                            self.add_nameserver(server)
-                            added_resolver = True
-                        else:
-                            trace("Rejected nameserver - wildcard:", server)
-                except Exception as e:
-                    #Rejected server :(
-                    trace("Rejected nameserver - unreliable:", server, type(e)) 
+            if not server:
+                continue
+            health = cache.get(server)
+            if health and now - health.get("checked", 0) < resolver_cache_ttl:
+                if health.get("ok"):
+                    cached.append((health.get("latency") or self.timeout, server))
+                else:
+                    trace("Skipping nameserver - failed recently:", server)
+            else:
+                servers.put(server)
+        cached.sort()
+        #The fastest recently good resolvers go first, they find this target's wildcards.
+        spot_checks = Queue.Queue()
+        for (latency, server) in cached[:resolver_spot_checks]:
+            spot_checks.put(server)
+        while not servers.empty():
+            spot_checks.put(servers.get_nowait())
+        servers = spot_checks
+        #The rest are trusted once the wildcards are known.
+        trusted = cached[resolver_spot_checks:]
+        threads = []
+        for x in range(min(self.verify_threads, servers.qsize())):
+            t = threading.Thread(target = self.verify_worker, args = (servers,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        added_resolver = False
+        while not self.time_to_die:
+            #Check before popping, a finished thread can't push anything new.
+            vetting = any(t.is_alive() for t in threads)
+            best = None
+            with self.verified_lock:
+                if trusted and self.passed:
+                    trace("Trusting", len(trusted), "cached nameservers")
+                    for entry in trusted:
+                        heapq.heappush(self.verified, entry)
+                    trusted = []
+                if self.verified:
+                    best = heapq.heappop(self.verified)
+            if best:
+                #wildcards have been added to the set, it is now safe to be added to the queue.
+                #blocking queue,  this process will halt on put() when the queue is full:
+                self.add_nameserver(best[1])
+                added_resolver = True
+            elif not vetting:
+                break
+            else:
+                time.sleep(0.05)
+        save_resolver_cache(self.health)
         return added_resolver
 
+    def verify_worker(self, servers):
+        resolver = dns.resolver.Resolver()
+        resolver.timeout = self.timeout
+        resolver.lifetime = self.timeout
+        while not self.time_to_die:
+            try:
+                server = servers.get_nowait()
+            except Queue.Empty:
+                return
+            resolver.nameservers = [server]
+            #[queries, seconds, timeouts, spam] measured while looking for wildcards.
+            stats = [0, 0.0, 0, False]
+            health = {"ok": False, "spam": False, "latency": None, "checked": time.time()}
+            try:
+                #Only add the nameserver to the queue if we can detect wildcards. 
+                if self.find_wildcards(self.target, resolver, stats):
+                    #Slow resolvers rank lower,  and so do the ones that dropped a query.
+                    latency = stats[1] / max(stats[0], 1)
+                    score = latency * (1 + stats[2])
+                    trace("Verified nameserver:", server, "latency: %.3fs" % latency, "timeouts:", stats[2])
+                    health["ok"] = True
+                    health["latency"] = score
+                    with self.verified_lock:
+                        heapq.heappush(self.verified, (score, server))
+                        self.passed += 1
+                elif stats[3]:
+                    health["spam"] = True
+                else:
+                    trace("Rejected nameserver - wildcard:", server)
+                    #Too many wildcards says more about the target than the resolver.
+                    health = None
+            except Exception as e:
+                #Rejected server :(
+                trace("Rejected nameserver - unreliable:", server, type(e)) 
+            if health:
+                with self.verified_lock:
+                    self.health[server] = health
+
     def run(self):
+        try:
+            #Lets test the letancy of our connection.
+            #Google's DNS server should be an ideal time test.
+            resolver = dns.resolver.Resolver()
+            resolver.nameservers = ['8.8.8.8']
+            resolver.timeout = 1
+            resolver.lifetime = 1
+            resolver.query(self.most_popular_website, self.record_type)
+        except:
+            #Our connection is slower than a junebug in molasses
+            self.timeout = dns.resolver.Resolver().lifetime
         #Every user will get a different set of resovlers, this helps redistribute traffic.
         random.shuffle(self.resolver_list)
         if not self.verify(self.resolver_list):
@@ -128,9 +347,23 @@ class verify_nameservers(multiprocessing.Process):
         except:
             pass
 
+    #Time one query,  a resolver that has answered before is given a second chance.
+    def probe(self, resolver, name, record_type, stats):
+        while True:
+            start = time.time()
+            try:
+                return resolver.query(name, record_type)
+            except dns.resolver.Timeout:
+                stats[2] += 1
+                if stats[2] > 1 or stats[0] == 0:
+                    raise
+            finally:
+                stats[0] += 1
+                stats[1] += time.time() - start
+
     #Only add the nameserver to the queue if we can detect wildcards. 
     #Returns False on error.
-    def find_wildcards(self, host):
+    def find_wildcards(self, host, resolver, stats):
         #We want sovle the following three problems:
         #1)The target might have a wildcard DNS record.
         #2)The target maybe using geolocaiton-aware DNS.
@@ -138,10 +371,14 @@ class verify_nameservers(multiprocessing.Process):
         #I have seen a CloudFlare Enterprise customer with the first two conditions.
         try:
             #This is case #3,  these spam nameservers seem to be more trouble then they are worth.
-             wildtest = self.resolver.query(uuid.uuid4().hex + ".com", "A")
+             wildtest = self.probe(resolver, uuid.uuid4().hex + ".com", "A", stats)
              if len(wildtest):
                 trace("Spam DNS detected:", host)
+                stats[3] = True
                 return False
+        except dns.resolver.Timeout:
+            #Dead or overloaded,  don't wait on it again.
+            raise
         except:
             pass
         test_counter = 8
@@ -152,70 +389,115 @@ class verify_nameservers(multiprocessing.Process):
             test_counter -= 1            
             try:
                 testdomain = "%s.%s" % (uuid.uuid4().hex, host)
-                wildtest = self.resolver.query(testdomain, self.record_type)
+                wildtest = self.probe(resolver, testdomain, self.record_type, stats)
                 #This 'A' record may contain a list of wildcards.
                 if wildtest:
                     for w in wildtest:
                         w = str(w)
-                        if w not in self.wildcards:
-                            #wildcards were detected.
-                            self.wildcards[w] = None
-                            #We found atleast one wildcard, look for more.
-                            looking_for_wildcards = True
+                        with self.verified_lock:
+                            if w not in self.wildcards:
+                                #wildcards were detected.
+                                self.wildcards[w] = None
+                                #We found atleast one wildcard, look for more.
+                                looking_for_wildcards = True
             except Exception as e:
                 if type(e) == dns.resolver.NXDOMAIN or type(e) == dns.name.EmptyLabel:
                     #not found
                     return True
                 else:
                     #This resolver maybe flakey, we don't want it for our tests.
-                    trace("wildcard exception:", self.resolver.nameservers, type(e)) 
+                    trace("wildcard exception:", resolver.nameservers, type(e)) 
                     return False 
         #If we hit the end of our depth counter and,
         #there are still wildcards, then reject this nameserver because it smells bad.
         return (test_counter >= 0)
 
+#A lookup that times out is retried by the same process after retry_backoff seconds,
+#twice that after the next timeout and so on,  at most retry_limit times.
+retry_backoff = 0.5
+retry_limit = 4
+
 class lookup(multiprocessing.Process):
 
-    def __init__(self, in_q, out_q, resolver_q, domain, wildcards, spider_blacklist):
+    def __init__(self, in_q, out_q, resolver_q, domain, batch_size = 64, flush_interval = 0.25, wordlist_file = None, seen = None, targets = None, answer_file = None):
         multiprocessing.Process.__init__(self, target = self.run)
         signal_init()
         self.required_nameservers = 16
+        #Both queues carry lists of messages,  one pickle and one lock per batch rather than per host.
         self.in_q = in_q
         self.out_q = out_q
         self.resolver_q = resolver_q        
         self.domain = domain
-        self.wildcards = wildcards
-        self.spider_blacklist = spider_blacklist
+        #Messages for the parent are sent when there are batch_size of them,
+        #or when the oldest has waited flush_interval seconds.
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.out_batch = []
+        self.out_batch_time = 0
+        #With a compiled wordlist the parent sends index ranges,  this process maps the file itself.
+        self.wordlist_file = wordlist_file
+        self.wordlist = None
+        #The parent's bloom_filter of queued hosts,  read only,  so spider hits it already has aren't sent.
+        self.seen = seen
+        #run_targets() shares this process between targets,  it checks their wildcards itself.
+        self.targets = targets
+        #The answer_cache is opened in run(),  a sqlite connection can't cross a fork.
+        self.answer_file = answer_file
+        self.answers = None
+        #What check() learned for the parent to cache,  (addresses, hosts, ttl) or None.
+        self.answer = None
+        #Both are local to this process, there is no round trip to a Manager on a lookup.
+        #Wildcards arrive with each nameserver from verify_nameservers.
+        self.wildcards = {}
+        #Spidered hosts this process has already reported,  run() owns the real blacklist.
+        self.spidered = set()
+        #Set when check() has put the host back on in_q or on the retry heap.
+        self.requeued = False
+        #(due, sequence, host, record_type, retries) of lookups that timed out.
+        self.retry_heap = []
+        self.retry_seq = 0
         self.resolver = dns.resolver.Resolver()
         #Force pydns to use our nameservers
         self.resolver.nameservers = []
 
+    def add_ns(self, item):
+        if item == False:
+            #Queue is empty,  inform the rest.
+            self.resolver_q.put(False)
+            return []
+        (nameserver, wildcards) = item
+        if not self.targets:
+            for w in wildcards:
+                self.wildcards[w] = None
+        return [nameserver]
+
     def get_ns(self):
         ret = []
         try:
-            ret = [self.resolver_q.get_nowait()]
-            if ret == False:
-                #Queue is empty,  inform the rest.
-                self.resolver_q.put(False)
-                ret = []
+            ret = self.add_ns(self.resolver_q.get_nowait())
         except:
             pass      
         return ret  
 
     def get_ns_blocking(self):
-        ret = []
-        ret = [self.resolver_q.get()]
-        if ret == False:
+        ret = self.add_ns(self.resolver_q.get())
+        if not ret:
             trace("get_ns_blocking - Resolver list is empty.")
-            #Queue is empty,  inform the rest.
-            self.resolver_q.put(False)
-            ret = []
         return ret
 
     def check(self, host, record_type = "A", retries = 0):
         trace("Checking:", host)
         cname_record = []
-        retries = 0        
+        #retries counts timeouts,  an empty answer is asked again right away,  once.
+        no_answers = 0
+        self.requeued = False
+        self.answer = None
+        if self.answers:
+            cached = self.answers.get(host, record_type)
+            if cached:
+                (addresses, hosts) = cached
+                self.spider(hosts, record_type)
+                return addresses or False
         if len(self.resolver.nameservers) <= self.required_nameservers:
             #This process needs more nameservers,  lets see if we have one avaible
             self.resolver.nameservers += self.get_ns()
@@ -226,12 +508,9 @@ class lookup(multiprocessing.Process):
                 if not record_type or record_type == "A":
                     resp = self.resolver.query(host)
                     #Crawl the response
-                    hosts = extract_hosts(str(resp.response), self.domain)
-                    for h in hosts:
-                        if h not in self.spider_blacklist:
-                            self.spider_blacklist[h]=None
-                            trace("Found host with spider:", h)
-                            self.in_q.put((h, record_type, 0))
+                    hosts = extract_hosts(str(resp.response), self.domain or target_of(host, self.targets))
+                    self.spider(hosts, record_type)
+                    self.answer = ([str(a) for a in resp], hosts, resp.rrset.ttl)
                     return resp
                 if record_type == "CNAME":
                     #A max 20 lookups
@@ -248,40 +527,42 @@ class lookup(multiprocessing.Process):
                             return cname_record                    
                 else:
                     #All other records:
-                    return self.resolver.query(host, record_type)
+                    resp = self.resolver.query(host, record_type)
+                    self.answer = ([str(a) for a in resp], [], resp.rrset.ttl)
+                    return resp
 
             except Exception as e:
                 if type(e) == dns.resolver.NoNameservers:
                     #We should never be here.
                     #We must block,  another process should try this host.
                     #do we need a limit?
-                    self.in_q.put((host, record_type, 0))
+                    self.in_q.put([(host, record_type, 0)])
+                    self.requeued = True
+                    #We may block on the resolver queue,  don't hold back the results meanwhile.
+                    self.flush()
                     self.resolver.nameservers += self.get_ns_blocking()
                     return False
                 elif type(e) == dns.resolver.NXDOMAIN:
                     #"Non-existent domain name."
+                    self.answer = (None, [], negative_ttl(e))
                     return False
                 elif type(e) == dns.resolver.NoAnswer:
                     #"The response did not contain an answer."
-                    if retries >= 1:
+                    if no_answers >= 1:
                         trace("NoAnswer retry")
+                        self.answer = (None, [], negative_ttl(e))
                         return False
-                    retries += 1
+                    no_answers += 1
                 elif type(e) == dns.resolver.Timeout:
                     trace("lookup failure:", host, retries)
                     #Check if it is time to give up.
-                    if retries >= 3:
-                        if retries > 3:
-                            #Sometimes 'internal use' subdomains will timeout for every request.
-                            #As far as I'm concerned, the authorative name server has told us this domain exists,
-                            #we just can't know the address value using this method.
-                            return ['Mutiple Query Timeout - External address resolution was restricted']
-                        else:
-                            #Maybe another process can take a crack at it.
-                            self.in_q.put((host, record_type, retries + 1))
+                    if retries >= retry_limit:
+                        trace("Giving up on:", host)
                         return False
-                    retries += 1
-                    #retry...
+                    #The nameserver that failed goes to the back of the line,  the retry asks another one first.
+                    self.resolver.nameservers = self.resolver.nameservers[1:] + self.resolver.nameservers[:1]
+                    self.defer(host, record_type, retries + 1)
+                    return False
                 elif type(e) == IndexError:
                     #Some old versions of dnspython throw this error,
                     #doesn't seem to affect the results,  and it was fixed in later versions.
@@ -289,7 +570,8 @@ class lookup(multiprocessing.Process):
                 elif type(e) == TypeError:
                     # We'll get here if the number procs > number of resolvers.
                     # This is an internal error do we need a limit?
-                    self.in_q.put((host, record_type, 0))
+                    self.in_q.put([(host, record_type, 0)])
+                    self.requeued = True
                     return False
                 elif type(e) == dns.rdatatype.UnknownRdatatype:
                     error("DNS record type not supported:", record_type)
@@ -298,60 +580,945 @@ class lookup(multiprocessing.Process):
                     #dnspython threw some strange exception...
                     raise e
 
+    def spider(self, hosts, record_type):
+        for h in hosts:
+            if h not in self.spidered and (self.seen is None or h not in self.seen):
+                self.spidered.add(h)
+                trace("Found host with spider:", h)
+                #run() decides if this host is new.
+                self.send(("spider", h, record_type))
+
+    def send(self, message):
+        if not self.out_batch:
+            self.out_batch_time = time.time()
+        self.out_batch.append(message)
+        if len(self.out_batch) >= self.batch_size or time.time() - self.out_batch_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.out_batch:
+            self.out_q.put(self.out_batch)
+            self.out_batch = []
+
     def run(self):
         #This process needs one resolver before it can start looking.
         self.resolver.nameservers += self.get_ns_blocking()
+        if self.answer_file:
+            self.answers = answer_cache(self.answer_file)
         while True:
-            found_addresses = []
-            work = self.in_q.get()
-            #Check if we have hit the end marker
-            while not work:
-                #Look for a re-queued lookup
+            if not self.resolver.nameservers:
+                #The other processes took every resolver,  leave the work to them.
+                trace("No nameservers left for this process")
+                if self.retry_heap:
+                    #The parent counts these as outstanding.
+                    self.in_q.put([(host, record_type, retries) for (due, seq, host, record_type, retries) in self.retry_heap])
+                self.flush()
+                self.out_q.put(False)
+                break
+            #Never block on the work queue while holding results,
+            #the parent can't send more work, or the end marker, until it has them.
+            self.flush()
+            self.retry_due()
+            if self.retry_heap:
+                #Wait for work no longer than the next retry.
                 try:
-                    work = self.in_q.get(blocking = False)
-                    #if we took the end marker of the queue we need to put it back
-                    if work:
-                        self.in_q.put(False)
-                except:#Queue.Empty
-                    trace('End of work queue')
-                    #There isn't an item behind the end marker
-                    work = False
-                    break
-            #Is this the end all work that needs to be done?
-            if not work:
+                    batch = self.in_q.get(True, max(0.001, self.retry_heap[0][0] - time.time()))
+                except Queue.Empty:
+                    continue
+            else:
+                batch = self.in_q.get()
+            #The parent only sends the end marker once every lookup has been answered,
+            #so there can't be a re-queued lookup behind it,  or one in a retry heap.
+            if not batch:
+                trace('End of work queue')
+                if self.answers:
+                    trace("answer cache hits:", self.answers.hits, "misses:", self.answers.misses)
                 #Perpetuate the end marker for all threads to see
                 self.in_q.put(False)
                 #Notify the parent that we have died of natural causes
                 self.out_q.put(False)
                 break
+            if isinstance(batch, tuple) and batch[0] == "wildcards":
+                (kind, target, record_type) = batch
+                self.send(("wildcards", target, probe_wildcards(self.resolver, target, record_type)))
+                continue
+            if isinstance(batch, tuple):
+                (kind, start, end, record_type) = batch
+                if not self.wordlist:
+                    self.wordlist = compiled_wordlist(self.wordlist_file)
+                batch = ((h, record_type) for h in self.wordlist.hosts(self.domain, start, end))
+            for work in batch:
+                #A retry that is due goes ahead of the rest of the batch.
+                self.retry_due()
+                self.resolve(*work)
+
+    #Looks up one host and reports it to the parent,  unless it is still outstanding.
+    def resolve(self, hostname, record_type, retries = 0):
+        found_addresses = []
+        response = self.check(hostname, record_type, retries)
+        sys.stdout.flush()
+        trace(response)                  
+        if self.requeued:
+            #Still outstanding,  another attempt will answer for it.
+            return
+        #self.wildcards is populated by the verify_nameservers() thread.
+        #This variable doesn't need a muetex, because it has a queue. 
+        #A queue ensure nameserver cannot be used before it's wildcard entries are found.
+        reject = False
+        if response:
+            for a in response:
+                a = str(a)
+                if a in self.wildcards:
+                    trace("resovled wildcard:", hostname)
+                    reject= True
+                    #reject this domain.
+                    break;
+                else:
+                    found_addresses.append(a)
+        if not response or reject:
+            found_addresses = None
+        #Every lookup is answered,  this is how the parent knows when all work is done.
+        #The answer is cached before the wildcard check,  a cached answer is checked again when it is used.
+        self.send(("result", hostname, record_type, found_addresses, self.answer))
+
+    #Timed out lookups wait in this process's retry heap,  see retry_backoff.
+    def defer(self, host, record_type, retries):
+        #Jitter keeps the retries of many processes from arriving together.
+        delay = retry_backoff * (2 ** (retries - 1)) * random.uniform(0.5, 1.5)
+        heapq.heappush(self.retry_heap, (time.time() + delay, self.retry_seq, host, record_type, retries))
+        self.retry_seq += 1
+        self.requeued = True
+
+    def retry_due(self):
+        while self.retry_heap and self.retry_heap[0][0] <= time.time():
+            (due, seq, host, record_type, retries) = heapq.heappop(self.retry_heap)
+            self.resolve(host, record_type, retries)
+
+#Follow the CNAMEs in an answer section the same way dns.resolver.Answer does.
+#Returns None if the message has no answer for this record type.
+def answer_rrset(message, qname, rdtype):
+    for x in range(16):
+        try:
+            return message.find_rrset(message.answer, qname, dns.rdataclass.IN, rdtype)
+        except KeyError:
+            try:
+                cname = message.find_rrset(message.answer, qname, dns.rdataclass.IN, dns.rdatatype.CNAME)
+            except KeyError:
+                return None
+            qname = cname[0].target
+    return None
+
+#The TCP fallback for truncated replies, dnspython 2.x only.
+try:
+    import dns.asyncquery
+except ImportError:
+    dns_asyncquery = None
+else:
+    dns_asyncquery = dns.asyncquery
+
+#Pacing for the engines that keep many queries in flight,  a token bucket per resolver.
+#Each resolver's bucket refills at its own rate,  which follows TCP's AIMD:  it triples every second
+#until the first loss and then grows by increase queries a second every second.  A timeout,
+#SERVFAIL or REFUSED halves it,  once per loss,  queries sent before the cut don't cut it again.
+#Each resolver settles at the rate it sustains instead of swinging between overload and idle.
+#The budget is a rate rather than a count of queries in flight,  rate limiting resolvers drop
+#queries silently and a dropped query would hold its place in flight until it timed out.
+class resolver_pacer(object):
+    def __init__(self, max_rate = 0, initial_rate = 100, increase = 10, min_rate = 1):
+        self.max_rate = max_rate
+        self.initial_rate = initial_rate
+        self.increase = increase
+        self.min_rate = min_rate
+        #Per resolver,  indexed like the engine's list of nameservers.
+        self.rate = []
+        self.threshold = []
+        self.tokens = []
+        self.stamp = []
+        self.last_cut = []
+        self.next = 0
+
+    def __len__(self):
+        return len(self.rate)
+
+    def add(self):
+        rate = float(self.initial_rate)
+        if self.max_rate:
+            rate = min(rate, self.max_rate)
+        self.rate.append(rate)
+        self.threshold.append(float("inf"))
+        self.tokens.append(1.0)
+        self.stamp.append(time.time())
+        self.last_cut.append(0.0)
+
+    def refill(self, i, now):
+        #50ms worth of queries may go out back to back.
+        burst = max(1.0, self.rate[i] / 20)
+        self.tokens[i] = min(burst, self.tokens[i] + (now - self.stamp[i]) * self.rate[i])
+        self.stamp[i] = now
+
+    #Takes a token from the next resolver that has one,  round robin.
+    #Returns its index,  or None if every resolver is at its rate.
+    def pick(self, now, exclude = -1):
+        n = len(self.rate)
+        for x in range(1, n + 1):
+            i = (self.next + x) % n
+            if i == exclude and n > 1:
+                continue
+            self.refill(i, now)
+            if self.tokens[i] < 1:
+                continue
+            self.next = i
+            self.tokens[i] -= 1
+            return i
+        return None
+
+    #The query picked for resolver i was never sent.
+    def cancel(self, i):
+        self.tokens[i] += 1
+
+    def answered(self, i):
+        if self.rate[i] < self.threshold[i]:
+            #Two more for every answer,  the rate triples every second.
+            self.rate[i] += 2
+        else:
+            self.rate[i] += self.increase / self.rate[i]
+        if self.max_rate and self.rate[i] > self.max_rate:
+            self.rate[i] = float(self.max_rate)
+
+    def failed(self, i, sent, now):
+        if sent >= self.last_cut[i]:
+            self.last_cut[i] = now
+            self.rate[i] = max(self.min_rate, self.rate[i] / 2)
+            self.threshold[i] = self.rate[i]
+
+    #Seconds until pick() will find a token.
+    def delay(self, now):
+        wait = 0.05
+        for i in range(len(self.rate)):
+            self.refill(i, now)
+            wait = min(wait, (1 - self.tokens[i]) / self.rate[i])
+        return max(wait, 0.001)
+
+class async_query(object):
+    #The state of one in-flight query of the async engine.
+    __slots__ = ["hostname", "record_type", "retries", "qname", "rdtype", "nameserver", "ns", "sent", "timer", "cname_record"]
+
+    def __init__(self, hostname, record_type, retries = 0, qname = None, rdtype = None, cname_record = None):
+        self.hostname = hostname
+        self.record_type = record_type
+        #keep track of how many times this lookup has failed.
+        self.retries = retries
+        #The name being asked for,  this changes while following a CNAME chain.
+        self.qname = qname or hostname
+        self.rdtype = rdtype or record_type or "A"
+        #The address and resolver_pacer index of the nameserver asked,  and when.
+        self.nameserver = None
+        self.ns = -1
+        self.sent = 0
+        self.timer = None
+        self.cname_record = cname_record or []
+
+class async_lookup(object):
+    #A single process replacement for a pool of lookup() processes.
+    #Thousands of queries are kept in flight over one non-blocking UDP socket,
+    #replies are matched to their query by the transaction ID, the question and the nameserver.
+    #This object is the asyncio DatagramProtocol for that socket.
+
+    def __init__(self, loop, domain, work, resolver_q, wildcards, spider_blacklist, concurrency = 1000, timeout = 2, answers = None, max_rate = 0):
+        self.loop = loop
+        self.domain = domain
+        #A (lazy) iterator of (hostname, record_type) tuples.
+        self.work = work
+        self.resolver_q = resolver_q
+        self.wildcards = wildcards
+        self.spider_blacklist = spider_blacklist
+        self.remember_all = isinstance(spider_blacklist, bloom_filter)
+        self.reported = {}
+        #An answer_cache,  or None.
+        self.answers = answers
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = 4
+        self.transport = None
+        self.nameservers = []
+        self.pacer = resolver_pacer(max_rate)
+        self.resolvers_done = False
+        #Spidered hosts go ahead of the wordlist.
+        self.requeued = collections.deque()
+        #Queries waiting for a resolver with a token,  see resolver_pacer.
+        self.waiting = collections.deque()
+        self.fill_timer = None
+        self.results = collections.deque()
+        #query id => async_query
+        self.pending = {}
+        #Truncated replies being retried over TCP.
+        self.tcp_pending = 0
+        self.work_done = False
+        self.finished = False
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.finish()
+
+    def error_received(self, exc):
+        #ICMP unreachable and friends,  the query will time out and be retried.
+        trace("async socket error:", exc)
+
+    def start(self):
+        self.poll_resolvers()
+
+    def finish(self):
+        self.finished = True
+        self.wake()
+
+    #The verify_nameservers() thread hands over resolvers once their wildcards are known.
+    def poll_resolvers(self):
+        if self.finished:
+            return
+        while not self.resolvers_done:
+            try:
+                ns = self.resolver_q.get_nowait()
+            except Queue.Empty:
+                break
+            if ns == False:
+                self.resolvers_done = True
+                if not self.nameservers:
+                    sys.stderr.write('Error: No nameservers found.\n')
+                    self.finish()
+                    return
+                continue
+            #The wildcards are already in self.wildcards, it is shared with the verify thread.
+            (ns, wildcards) = ns
+            if ':' in ns:
+                #The socket is IPv4.
+                trace("Skipping IPv6 nameserver:", ns)
+            else:
+                self.nameservers.append(ns)
+                self.pacer.add()
+        self.fill()
+        if not self.resolvers_done:
+            self.loop.call_later(0.05, self.poll_resolvers)
+
+    #self.work is a brute_scheduler,  it can gain work from any result so it is asked again every time.
+    #Hosts the answer_cache can settle never become a query.
+    def next_work(self):
+        while True:
+            while self.requeued:
+                query = self.requeued.popleft()
+                if not self.cached(query.hostname, query.record_type):
+                    return query
+            for (hostname, record_type) in self.work:
+                #Only spidered hosts are remembered,  the wordlist is streamed.
+                #A bloom filter is small enough to remember every host.
+                if self.remember_all:
+                    if self.spider_blacklist.add(hostname):
+                        continue
+                elif hostname in self.spider_blacklist:
+                    continue
+                if not self.cached(hostname, record_type):
+                    return async_query(hostname, record_type)
+                if self.requeued:
+                    #A cached answer spidered new hosts,  they go first.
+                    break
+            else:
+                self.work_done = True
+                return None
+
+    #Returns True if the answer_cache has a fresh answer for this host,  a positive one is reported.
+    def cached(self, hostname, record_type):
+        if not self.answers:
+            return False
+        cached = self.answers.get(hostname, record_type)
+        if not cached:
+            return False
+        (addresses, hosts) = cached
+        if addresses:
+            self.spider(hosts, record_type)
+            self.add_result(hostname, record_type, addresses)
+        return True
+
+    def spider(self, hosts, record_type):
+        for h in hosts:
+            if h not in self.spider_blacklist:
+                self.spider_blacklist[h] = None
+                trace("Found host with spider:", h)
+                self.requeued.append(async_query(h, record_type))
+
+    def remember(self, query, addresses, hosts, ttl):
+        if self.answers and query.record_type != "CNAME":
+            self.answers.put(query.hostname, query.record_type, addresses, hosts, ttl)
+
+    #Keep the socket busy, up to self.concurrency queries in flight.
+    def fill(self):
+        if self.finished or not self.nameservers:
+            return
+        while len(self.pending) + self.tcp_pending < self.concurrency:
+            if self.waiting:
+                query = self.waiting.popleft()
+            else:
+                query = self.next_work()
+                if not query:
+                    break
+            if not self.send(query):
+                break
+        if self.waiting and not self.fill_timer:
+            #Every resolver is at its rate,  try again once a token bucket has refilled.
+            self.fill_timer = self.loop.call_later(self.pacer.delay(time.time()), self.refill)
+        if not self.pending and not self.tcp_pending and not self.requeued and not self.waiting and self.work_done:
+            trace("End of work queue")
+            self.finish()
+
+    def refill(self):
+        self.fill_timer = None
+        self.fill()
+
+    def make_message(self, query):
+        try:
+            message = dns.message.make_query(query.qname, query.rdtype)
+        except Exception as e:
+            if type(e) == dns.rdatatype.UnknownRdatatype:
+                error("DNS record type not supported:", query.rdtype)
+            #Not a valid hostname, such as an empty label.
+            trace("Problem processing host:", query.hostname, type(e))
+            return None
+        return message
+
+    #Returns False if no resolver has a token,  the query then waits for fill() to send it.
+    def send(self, query, exclude = -1):
+        message = self.make_message(query)
+        if not message:
+            return True
+        now = time.time()
+        #Don't retry on the resolver that just failed us.
+        ns = self.pacer.pick(now, exclude)
+        if ns is None:
+            self.waiting.appendleft(query)
+            return False
+        query.ns = ns
+        query.nameserver = self.nameservers[ns]
+        query.sent = now
+        qid = random.randint(0, 65535)
+        while qid in self.pending:
+            qid = random.randint(0, 65535)
+        message.id = qid
+        #Compare replies against the name as dnspython parsed it.
+        query.qname = message.question[0].name
+        query.timer = self.loop.call_later(self.timeout, self.query_timeout, qid)
+        self.pending[qid] = query
+        self.transport.sendto(message.to_wire(), (query.nameserver, 53))
+        return True
+
+    def query_timeout(self, qid):
+        query = self.pending.pop(qid, None)
+        if query:
+            trace("lookup failure:", query.hostname, query.retries)
+            self.pacer.failed(query.ns, query.sent, time.time())
+            self.retry(query)
+            self.fill()
+
+    def retry(self, query):
+        #Check if it is time to give up.
+        if query.retries >= self.max_retries:
+            trace("Giving up on:", query.hostname)
+        else:
+            #Another nameserver can take a crack at it.
+            query.retries += 1
+            self.send(query, query.ns)
+
+    def datagram_received(self, data, addr):
+        try:
+            response = dns.message.from_wire(data)
+            qid = response.id
+        except Exception as e:
+            #A truncated reply may not parse, but its header is still good.
+            if len(data) < 12 or not (ord(data[2:3]) << 8) & dns.flags.TC:
+                trace("Malformed DNS response from:", addr, type(e))
+                return
+            response = None
+            qid = (ord(data[0:1]) << 8) + ord(data[1:2])
+        query = self.pending.get(qid)
+        #Make sure this is the answer to our question from the nameserver we asked,
+        #not a late reply to a recycled id or a spoofed packet.
+        if not query or addr[0] != query.nameserver:
+            return
+        if response and (not response.question or response.question[0].name != query.qname or response.question[0].rdtype != dns.rdatatype.from_text(query.rdtype)):
+            return
+        del self.pending[qid]
+        query.timer.cancel()
+        if response and response.rcode() != dns.rcode.NOERROR and response.rcode() != dns.rcode.NXDOMAIN:
+            self.pacer.failed(query.ns, query.sent, time.time())
+        else:
+            self.pacer.answered(query.ns)
+        if response is None or response.flags & dns.flags.TC:
+            self.truncated(query)
+        else:
+            self.check(query, response)
+        self.fill()
+
+    #dnspython's Resolver.query() retries a truncated reply over TCP, so do we.
+    def truncated(self, query):
+        message = self.make_message(query)
+        if not message:
+            return
+        if dns_asyncquery is None:
+            trace("Truncated reply, trying another nameserver:", query.hostname)
+            self.retry(query)
+            return
+        trace("Truncated reply, retrying over TCP:", query.hostname)
+        self.tcp_pending += 1
+        future = self.loop.create_task(dns_asyncquery.tcp(message, query.nameserver, timeout = self.timeout))
+        future.add_done_callback(lambda f: self.tcp_done(query, f))
+
+    def tcp_done(self, query, future):
+        self.tcp_pending -= 1
+        if self.finished:
+            return
+        if future.cancelled() or future.exception():
+            trace("TCP lookup failure:", query.hostname)
+            self.retry(query)
+        else:
+            self.check(query, future.result())
+        self.fill()
+
+    #The lookup.check() and lookup.run() logic,  driven by a reply instead of an exception.
+    def check(self, query, response):
+        rcode = response.rcode()
+        if rcode == dns.rcode.NXDOMAIN:
+            #"Non-existent domain name."
+            self.remember(query, None, [], negative_ttl(response))
+            return
+        if rcode != dns.rcode.NOERROR:
+            #SERVFAIL or REFUSED, another nameserver can take a crack at it.
+            self.retry(query)
+            return
+        if query.record_type == "CNAME":
+            try:
+                cname = response.find_rrset(response.answer, query.qname, dns.rdataclass.IN, dns.rdatatype.CNAME)
+            except KeyError:
+                cname = None
+            #A max 20 lookups
+            if cname and len(query.cname_record) < 20:
+                target = str(cname[0]).rstrip(".")
+                query.cname_record.append(target)
+                query.qname = target
+                self.send(query)
+            else:
+                self.add_result(query.hostname, query.record_type, query.cname_record)
+            return
+        answer = answer_rrset(response, query.qname, dns.rdatatype.from_text(query.rdtype))
+        if not answer:
+            #"The response did not contain an answer."
+            if query.retries < 1:
+                query.retries += 1
+                self.send(query, query.ns)
+            else:
+                self.remember(query, None, [], negative_ttl(response))
+            return
+        hosts = []
+        if not query.record_type or query.record_type == "A":
+            #Crawl the response
+            hosts = extract_hosts(response.to_text(), self.domain)
+            self.spider(hosts, query.record_type)
+        self.remember(query, [str(a) for a in answer], hosts, answer.ttl)
+        self.add_result(query.hostname, query.record_type, answer)
+
+    def add_result(self, hostname, record_type, response):
+        found_addresses = []
+        if not response:
+            return
+        for a in response:
+            a = str(a)
+            if a in self.wildcards:
+                trace("resovled wildcard:", hostname)
+                #reject this domain.
+                return
+            found_addresses.append(a)
+        #A spidered host can also come up in the wordlist,  report it once.
+        if hostname in self.reported:
+            return
+        self.reported[hostname] = None
+        self.work.found(hostname)
+        self.results.append((hostname, record_type, found_addresses))
+        self.wake()
+
+    def wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    #Returns a future which completes once there are results to collect.
+    def wait(self):
+        self.waiter = self.loop.create_future()
+        if self.results or self.finished:
+            self.waiter.set_result(None)
+        return self.waiter
+
+#The fixed part of every query the blaster sends: RD set, one question, no other records.
+blast_header = b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00"
+
+#slot_sent of a slot that is waiting for a resolver,  it never times out.
+blast_waiting = float("inf")
+
+#Encode a hostname as DNS wire labels,  returns None if it can't be a hostname.
+def wire_name(hostname):
+    ret = b""
+    for label in hostname.rstrip(".").split("."):
+        label = label.encode("idna") if not isinstance(label, bytes) else label
+        if not label or len(label) > 63:
+            return None
+        ret += struct.pack("B", len(label)) + label
+    ret += b"\x00"
+    if len(ret) > 255:
+        return None
+    return ret
+
+class blast_lookup(object):
+    #A stateless, massdns-style engine.
+    #Query packets are built from a template by patching the transaction ID and the qname,
+    #and fired at the verified resolvers from a handful of non-blocking sockets.
+    #NXDOMAIN and empty replies are recognised from the header alone,
+    #only hits are handed to dnspython for parsing.
+    #In-flight queries live in a fixed table of slots, the slot number is the transaction ID.
+
+    def __init__(self, domain, record_type, work, resolver_q, wildcards, spider_blacklist, concurrency = 10000, timeout = 2, socket_count = 4, answers = None, max_rate = 0):
+        self.domain = domain
+        self.record_type = record_type
+        self.rdtype = dns.rdatatype.from_text(record_type or "A")
+        #Everything after the qname: qtype and class IN.
+        self.question_tail = struct.pack(">HH", self.rdtype, dns.rdataclass.IN)
+        self.work = work
+        self.resolver_q = resolver_q
+        self.wildcards = wildcards
+        self.spider_blacklist = spider_blacklist
+        self.remember_all = isinstance(spider_blacklist, bloom_filter)
+        self.reported = {}
+        #An answer_cache,  or None.
+        self.answers = answers
+        #The transaction ID is the slot number, so there can't be more than 65536 slots.
+        self.concurrency = min(concurrency, 65536)
+        self.timeout = timeout
+        self.max_retries = 4
+        self.nameservers = []
+        self.pacer = resolver_pacer(max_rate)
+        self.resolvers_done = False
+        self.work_done = False
+        self.finished = False
+        #Spidered hosts go ahead of the wordlist.
+        self.requeued = collections.deque()
+        #Slots waiting for a resolver with a token,  see resolver_pacer.
+        self.waiting = collections.deque()
+        self.results = collections.deque()
+        self.sockets = []
+        for x in range(socket_count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            except socket.error:
+                pass
+            s.setblocking(False)
+            self.sockets.append(s)
+        #The slot table.
+        n = self.concurrency
+        #Hostname and question (qname + qtype + class) of each slot,  None when the slot is free.
+        self.slot_host = [None] * n
+        self.slot_question = [None] * n
+        #CNAME chains being followed, only hits ever get an entry.
+        self.slot_cname = {}
+        self.slot_sent = array.array("d", [0.0]) * n
+        self.slot_tries = array.array("B", [0]) * n
+        self.slot_ns = array.array("H", [0]) * n
+        self.free_slots = list(range(n - 1, -1, -1))
+        self.last_sweep = time.time()
+
+    def close(self):
+        for s in self.sockets:
+            s.close()
+
+    def poll_resolvers(self):
+        while not self.resolvers_done:
+            try:
+                ns = self.resolver_q.get_nowait()
+            except Queue.Empty:
+                break
+            if ns == False:
+                self.resolvers_done = True
+                if not self.nameservers:
+                    sys.stderr.write('Error: No nameservers found.\n')
+                    self.finished = True
+                continue
+            #The wildcards are already in self.wildcards, it is shared with the verify thread.
+            (ns, wildcards) = ns
+            if ':' in ns:
+                #The sockets are IPv4.
+                trace("Skipping IPv6 nameserver:", ns)
+            elif len(self.nameservers) < 65536:
+                self.nameservers.append(ns)
+                self.pacer.add()
+
+    #self.work is a brute_scheduler,  it can gain work from any result so it is asked again every time.
+    #Hosts the answer_cache can settle never take a slot.
+    def next_work(self):
+        while True:
+            while self.requeued:
+                hostname = self.requeued.popleft()
+                if not self.cached(hostname):
+                    return hostname
+            for (hostname, record_type) in self.work:
+                #Only spidered hosts are remembered,  the wordlist is streamed.
+                #A bloom filter is small enough to remember every host.
+                if self.remember_all:
+                    if self.spider_blacklist.add(hostname):
+                        continue
+                elif hostname in self.spider_blacklist:
+                    continue
+                if not self.cached(hostname):
+                    return hostname
+                if self.requeued:
+                    #A cached answer spidered new hosts,  they go first.
+                    break
             else:
-                if len(work) == 3:
-                    #keep track of how many times this lookup has timedout.
-                    (hostname, record_type, timeout_retries) = work
-                    response = self.check(hostname, record_type, timeout_retries)
+                self.work_done = True
+                return None
+
+    #Returns True if the answer_cache has a fresh answer for this host,  a positive one is reported.
+    def cached(self, hostname):
+        if not self.answers:
+            return False
+        cached = self.answers.get(hostname, self.record_type)
+        if not cached:
+            return False
+        (addresses, hosts) = cached
+        if addresses:
+            self.spider(hosts)
+            self.add_result(hostname, addresses)
+        return True
+
+    def spider(self, hosts):
+        for h in hosts:
+            if h not in self.spider_blacklist:
+                self.spider_blacklist[h] = None
+                trace("Found host with spider:", h)
+                self.requeued.append(h)
+
+    def remember(self, slot, addresses, hosts, ttl):
+        if self.answers and self.record_type != "CNAME":
+            self.answers.put(self.slot_host[slot], self.record_type, addresses, hosts, ttl)
+
+    #Negative answers are recognised from the header,  the SOA is only parsed when they are cached.
+    def remember_negative(self, slot, data):
+        if self.answers:
+            try:
+                ttl = negative_ttl(dns.message.from_wire(data))
+            except Exception:
+                return
+            self.remember(slot, None, [], ttl)
+
+    #Keep every slot busy.
+    def fill(self):
+        if not self.nameservers:
+            return
+        while self.waiting:
+            if not self.send(self.waiting.popleft()):
+                return
+        while self.free_slots:
+            hostname = self.next_work()
+            if not hostname:
+                break
+            qname = wire_name(hostname)
+            if not qname:
+                trace("Problem processing host:", hostname)
+                continue
+            slot = self.free_slots.pop()
+            self.slot_host[slot] = hostname
+            self.slot_question[slot] = qname + self.question_tail
+            self.slot_tries[slot] = 0
+            if not self.send(slot):
+                #Every resolver is at its rate,  or the socket buffers are full,  try again on the next pass.
+                break
+
+    #Returns False if the query couldn't be sent,  the slot then waits for fill() to send it.
+    def send(self, slot, exclude = -1):
+        now = time.time()
+        #Don't retry on the resolver that just failed us.
+        ns = self.pacer.pick(now, exclude)
+        if ns is not None:
+            self.slot_ns[slot] = ns
+            self.slot_sent[slot] = now
+            packet = struct.pack(">H", slot) + blast_header + self.slot_question[slot]
+            try:
+                self.sockets[slot % len(self.sockets)].sendto(packet, (self.nameservers[ns], 53))
+                return True
+            except socket.error:
+                #EAGAIN, or a bad resolver address.
+                self.pacer.cancel(ns)
+        #Not in flight,  the sweep and late replies leave it alone.
+        self.slot_sent[slot] = blast_waiting
+        self.waiting.appendleft(slot)
+        return False
+
+    def release(self, slot):
+        self.slot_host[slot] = None
+        self.slot_question[slot] = None
+        self.slot_cname.pop(slot, None)
+        self.free_slots.append(slot)
+
+    def retry(self, slot):
+        #Check if it is time to give up.
+        if self.slot_tries[slot] >= self.max_retries:
+            trace("Giving up on:", self.slot_host[slot])
+            self.release(slot)
+        else:
+            self.slot_tries[slot] += 1
+            self.send(slot, self.slot_ns[slot])
+
+    #Timeouts are found by sweeping the table, there are no per-query timers.
+    def sweep(self, now):
+        expired = now - self.timeout
+        slot_host = self.slot_host
+        slot_sent = self.slot_sent
+        for slot in range(self.concurrency):
+            if slot_host[slot] is not None and slot_sent[slot] < expired:
+                trace("lookup failure:", slot_host[slot], self.slot_tries[slot])
+                self.pacer.failed(self.slot_ns[slot], slot_sent[slot], now)
+                self.retry(slot)
+        self.last_sweep = now
+
+    def receive(self, sock):
+        while True:
+            try:
+                (data, addr) = sock.recvfrom(4096)
+            except socket.error:
+                #EAGAIN, this socket is drained.
+                return
+            if len(data) < 12:
+                continue
+            (slot, flags, qdcount, ancount) = struct.unpack(">HHHH", data[:8])
+            if slot >= self.concurrency or self.slot_host[slot] is None or self.slot_sent[slot] == blast_waiting:
+                continue
+            question = self.slot_question[slot]
+            #Make sure this is the answer to our question from the nameserver we asked,
+            #not a late reply to a reused slot or a spoofed packet.
+            if addr[0] != self.nameservers[self.slot_ns[slot]] or data[12:12 + len(question)].lower() != question.lower():
+                continue
+            rcode = flags & 0xf
+            if rcode == dns.rcode.NOERROR or rcode == dns.rcode.NXDOMAIN:
+                self.pacer.answered(self.slot_ns[slot])
+            else:
+                self.pacer.failed(self.slot_ns[slot], self.slot_sent[slot], time.time())
+            if rcode == dns.rcode.NXDOMAIN:
+                #"Non-existent domain name."
+                self.remember_negative(slot, data)
+                self.release(slot)
+            elif rcode != dns.rcode.NOERROR:
+                #SERVFAIL or REFUSED, another nameserver can take a crack at it.
+                self.retry(slot)
+            elif flags & dns.flags.TC:
+                self.truncated(slot)
+            elif not ancount:
+                #"The response did not contain an answer."
+                if self.slot_tries[slot] < 1:
+                    self.retry(slot)
                 else:
-                    (hostname, record_type) = work
-                    response = self.check(hostname, record_type) 
-                sys.stdout.flush()
-                trace(response)                  
-                #self.wildcards is populated by the verify_nameservers() thread.
-                #This variable doesn't need a muetex, because it has a queue. 
-                #A queue ensure nameserver cannot be used before it's wildcard entries are found.
-                reject = False
-                if response:
-                    for a in response:
-                        a = str(a)
-                        if a in self.wildcards:
-                            trace("resovled wildcard:", hostname)
-                            reject= True
-                            #reject this domain.
-                            break;
-                        else:
-                            found_addresses.append(a)
-                    if not reject:
-                        #This request is filled, send the results back  
-                        result = (hostname, record_type, found_addresses)
-                        self.out_q.put(result)
+                    self.remember_negative(slot, data)
+                    self.release(slot)
+            else:
+                try:
+                    response = dns.message.from_wire(data)
+                except Exception as e:
+                    trace("Malformed DNS response from:", addr, type(e))
+                    self.retry(slot)
+                    continue
+                self.check(slot, response)
+
+    #Truncated replies are rare enough to be retried over blocking TCP.
+    def truncated(self, slot):
+        trace("Truncated reply, retrying over TCP:", self.slot_host[slot])
+        query = dns.message.from_wire(struct.pack(">H", slot) + blast_header + self.slot_question[slot])
+        try:
+            response = dns.query.tcp(query, self.nameservers[self.slot_ns[slot]], timeout = self.timeout)
+        except Exception:
+            self.retry(slot)
+            return
+        self.check(slot, response)
+
+    #A hit,  the same checks as lookup.check() and lookup.run()
+    def check(self, slot, response):
+        hostname = self.slot_host[slot]
+        qname = response.question[0].name
+        if self.record_type == "CNAME":
+            cname_record = self.slot_cname.setdefault(slot, [])
+            try:
+                cname = response.find_rrset(response.answer, qname, dns.rdataclass.IN, dns.rdatatype.CNAME)
+            except KeyError:
+                cname = None
+            target = cname and wire_name(str(cname[0]))
+            #A max 20 lookups
+            if target and len(cname_record) < 20:
+                cname_record.append(str(cname[0]).rstrip("."))
+                self.slot_question[slot] = target + self.question_tail
+                self.send(slot)
+            else:
+                self.add_result(hostname, cname_record)
+                self.release(slot)
+            return
+        answer = answer_rrset(response, qname, self.rdtype)
+        if not answer:
+            if self.slot_tries[slot] < 1:
+                self.retry(slot)
+            else:
+                self.remember(slot, None, [], negative_ttl(response))
+                self.release(slot)
+            return
+        hosts = []
+        if not self.record_type or self.record_type == "A":
+            #Crawl the response
+            hosts = extract_hosts(response.to_text(), self.domain)
+            self.spider(hosts)
+        self.remember(slot, [str(a) for a in answer], hosts, answer.ttl)
+        self.add_result(hostname, answer)
+        self.release(slot)
+
+    def add_result(self, hostname, response):
+        found_addresses = []
+        if not response:
+            return
+        for a in response:
+            a = str(a)
+            if a in self.wildcards:
+                trace("resovled wildcard:", hostname)
+                #reject this domain.
+                return
+            found_addresses.append(a)
+        #A spidered host can also come up in the wordlist,  report it once.
+        if hostname in self.reported:
+            return
+        self.reported[hostname] = None
+        self.work.found(hostname)
+        self.results.append((hostname, self.record_type, found_addresses))
+
+    #One pass of the event loop:  top up the slots, wait for replies, look for timeouts.
+    def step(self):
+        if not self.resolvers_done:
+            self.poll_resolvers()
+        self.fill()
+        if len(self.free_slots) == self.concurrency and not self.requeued and self.work_done:
+            trace("End of work queue")
+            self.finished = True
+            return
+        wait = 0.05
+        if self.waiting:
+            wait = self.pacer.delay(time.time())
+        try:
+            (readable, writable, broken) = select.select(self.sockets, [], [], wait)
+        except select.error:
+            readable = []
+        for sock in readable:
+            self.receive(sock)
+        now = time.time()
+        if now - self.last_sweep >= self.timeout / 4.0:
+            self.sweep(now)
 
 #Extract relevant hosts
 #The dot at the end of a domain signifies the root,
@@ -372,14 +1539,11 @@ def extract_hosts(data, hostname):
 #Return a list of unique sub domains,  sorted by frequency.
 #Only match domains that have 3 or more sections subdomain.domain.tld
 domain_match = re.compile("([a-zA-Z0-9_-]*\.[a-zA-Z0-9_-]*\.[a-zA-Z0-9_-]*)+")
-def extract_subdomains(file_name):
+def count_subdomains(data):
     #Avoid re-compilation
     global domain_match
     subs = {}
-    sub_file = open(file_name).read()
-    f_all = re.findall(domain_match, sub_file)
-    del sub_file
-    for i in f_all:
+    for i in re.findall(domain_match, data):
         if i.find(".") >= 0:
             p = i.split(".")[0:-1]
             #gobble everything that might be a TLD
@@ -398,90 +1562,267 @@ def extract_subdomains(file_name):
                             subs[q] += 1
                         else:
                             subs[q] = 1
-    #Free some memory before the sort...
-    del f_all
+    return subs
+
+#Crawl dumps can be many gigabytes,  read them a chunk at a time.
+#Chunks end on a line break so no domain name is cut in two,  gzip files are read as they are.
+def read_chunks(file_name, chunk_size = 16 * 1024 * 1024):
+    try:
+        f = open(file_name, "rb")
+    except:
+        error("File not found:", file_name)
+    if f.read(2) == b"\x1f\x8b":
+        f.close()
+        f = gzip.open(file_name, "rb")
+    else:
+        f.seek(0)
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk += f.readline()
+            #Domain names are ascii,  latin-1 never fails to decode and keeps everything else out of the way.
+            yield chunk.decode("latin-1")
+    finally:
+        f.close()
+
+#Count labels in the corpus on every core.  Only a few chunks are read ahead of the workers,
+#so memory is bounded by the chunk size and the number of distinct labels.
+#merge_file is an existing wordlist to add the new counts to,  see compile_wordlist() for its format.
+def count_subdomains_file(file_name, process_count = None, merge_file = None, chunk_size = 16 * 1024 * 1024):
+    subs = {}
+    order = {}
+    def merge(counts):
+        for (q, c) in counts.items():
+            if q in subs:
+                subs[q] += c
+            else:
+                subs[q] = c
+                order[q] = len(order)
+    if merge_file:
+        for line in open_wordlist(merge_file):
+            fields = str(line).strip().split(",")
+            if not fields[0]:
+                continue
+            try:
+                count = int(fields[1])
+            except (IndexError, ValueError):
+                #A plain list like names.txt is already in frequency order,  which is kept for ties.
+                count = 0
+            merge({fields[0].lower(): count})
+    if not process_count:
+        process_count = multiprocessing.cpu_count()
+    if process_count <= 1 or sys.platform.startswith('win'):
+        for chunk in read_chunks(file_name, chunk_size):
+            merge(count_subdomains(chunk))
+    else:
+        pool = multiprocessing.Pool(process_count)
+        pending = collections.deque()
+        try:
+            for chunk in read_chunks(file_name, chunk_size):
+                pending.append(pool.apply_async(count_subdomains, (chunk,)))
+                del chunk
+                #Don't read further ahead than the workers can keep up with.
+                while len(pending) >= process_count * 2:
+                    merge(pending.popleft().get())
+            while pending:
+                merge(pending.popleft().get())
+        finally:
+            pool.terminate()
+    return (subs, order)
+
+#Return a list of unique sub domains,  sorted by frequency.
+def extract_subdomains(file_name, process_count = None, merge_file = None, with_counts = False):
+    (subs, order) = count_subdomains_file(file_name, process_count, merge_file)
     #Sort by freq in desc order
-    subs_sorted = sorted(subs.keys(), key = lambda x: subs[x], reverse = True)
+    subs_sorted = sorted(subs.keys(), key = lambda x: (-subs[x], order[x]))
+    if with_counts:
+        return [(q, subs[q]) for q in subs_sorted]
     return subs_sorted
 
-def print_target(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, output = False, json_output = False, found_subdomains=[],verbose=False):
-    subdomains_list = []
-    results_temp = []
-    run(target, record_type, subdomains, resolve_list, process_count)
-    for result in run(target, record_type, subdomains, resolve_list, process_count):
-        (hostname, record_type, response) = result
-        if not record_type:
-            result = hostname
-        else:
-            result = "%s,%s" % (hostname, ",".join(response).strip(","))
-        if result not in found_subdomains:
+#The available brute force engines:
+#process - a pool of lookup() processes, each doing one blocking query at a time.
+#async - a single process asyncio event loop with thousands of queries in flight.
+#blast - stateless, pre-built query packets and a fixed slot table, for very large wordlists.
+engines = ["process", "async", "blast"]
+
+#process_count only applies to the process engine,  concurrency and timeout only to the async and blast engines.
+#The brute force results as they arrive,  (hostname, record_type, addresses) for every host
+#that isn't in found_subdomains.  callback,  if given,  is called with each one as well,
+#so output, port scans or probes can start long before the wordlist is finished.
+#permute tries permutations() of found_subdomains before the wordlist.
+#answer_file is an answer_cache,  hosts with a fresh cached answer are not asked again.
+#resolver_rate caps the queries a second the async and blast engines send each resolver.
+def stream_target(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, found_subdomains = [], engine = "process", concurrency = 1000, timeout = 2, permute = False, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, callback = None, answer_file = None, resolver_rate = 0):
+    #Checking every result against a list is quadratic.
+    found = set(found_subdomains)
+    hosts = None
+    if permute and found_subdomains:
+        hosts = permutations(target, found_subdomains)
+    if engine == "async":
+        results = run_async(target, record_type, subdomains, resolve_list, concurrency, timeout, hosts = hosts, bloom_capacity = bloom_capacity, bloom_error_rate = bloom_error_rate, recursive = recursive, max_depth = max_depth, budget = budget, answer_file = answer_file, resolver_rate = resolver_rate)
+    elif engine == "blast":
+        results = run_blast(target, record_type, subdomains, resolve_list, concurrency, timeout, hosts = hosts, bloom_capacity = bloom_capacity, bloom_error_rate = bloom_error_rate, recursive = recursive, max_depth = max_depth, budget = budget, answer_file = answer_file, resolver_rate = resolver_rate)
+    elif engine == "process":
+        results = run(target, record_type, subdomains, resolve_list, process_count, hosts = hosts, bloom_capacity = bloom_capacity, bloom_error_rate = bloom_error_rate, recursive = recursive, max_depth = max_depth, budget = budget, answer_file = answer_file)
+    else:
+        error("Unknown engine:", engine)
+    for (hostname, result_type, response) in results:
+        if format_result(hostname, result_type, response) in found:
+            continue
+        if callback:
+            callback(hostname, result_type, response)
+        yield (hostname, result_type, response)
+
+#How print_target() shows a result,  the hostname,  or "hostname,address,..." when a record type was asked for.
+def format_result(hostname, record_type, response):
+    if not record_type:
+        return hostname
+    return "%s,%s" % (hostname, ",".join(response).strip(","))
+
+#Collects stream_target() into a set,  printing each result as it arrives when verbose.
+def print_target(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, output = False, json_output = False, found_subdomains=[],verbose=False, engine = "process", concurrency = 1000, timeout = 2, permute = False, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None, resolver_rate = 0):
+    subdomains_list = set()
+    for (hostname, result_type, response) in stream_target(target, record_type, subdomains, resolve_list, process_count, found_subdomains, engine, concurrency, timeout, permute, bloom_capacity, bloom_error_rate, recursive, max_depth, budget, answer_file = answer_file, resolver_rate = resolver_rate):
+        result = format_result(hostname, result_type, response)
+        if verbose:
+            print(result)
+        subdomains_list.add(result)
+    return subdomains_list
+
+#print_target() for many targets at once,  they share one pool of lookup processes,  see run_targets().
+#Returns a dict of target -> set of results.
+def print_targets(targets, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, output = False, json_output = False, found_subdomains = [], verbose = False, permute = False, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None):
+    hosts = None
+    if permute and found_subdomains:
+        hosts = dict((t.strip().lower().rstrip("."), permutations(t.strip(), found_subdomains)) for t in targets if t.strip())
+    found = set(found_subdomains)
+    subdomains_lists = {}
+    for (target, hostname, result_type, response) in run_targets(targets, record_type, subdomains, resolve_list, process_count, hosts = hosts, bloom_capacity = bloom_capacity, bloom_error_rate = bloom_error_rate, recursive = recursive, max_depth = max_depth, budget = budget, answer_file = answer_file):
+        if hostname is None:
+            trace("Finished target:", target)
+            continue
+        result = format_result(hostname, result_type, response)
+        if result not in found:
             if verbose:
                 print(result)
-            subdomains_list.append(result)
-
-    return  set(subdomains_list)
+            subdomains_lists.setdefault(target, set()).add(result)
+    return subdomains_lists
 
-def run(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16):
-    subdomains = check_open(subdomains)
+#hosts is an optional iterable of extra candidates,  such as permutations(),  tried before the wordlist.
+#bloom_capacity replaces the dict of queued hosts with a bloom_filter sized for that many names.
+#recursive, max_depth and budget are passed to the brute_scheduler.
+def run(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, batch_size = 64, flush_interval = 0.25, window = 0, hosts = None, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None):
+    subdomains_file = subdomains
+    subdomains = open_wordlist(subdomains)
     resolve_list = check_open(resolve_list)
     if (len(resolve_list) / 16) < process_count:
         sys.stderr.write('Warning: Fewer than 16 resovlers per thread, consider adding more nameservers to resolvers.txt.\n')
-    if os.name == 'nt':
-        wildcards = {}
-        spider_blacklist = {}
-    else:
-        wildcards = multiprocessing.Manager().dict()
-        spider_blacklist = multiprocessing.Manager().dict()
+    #Only this process reads or writes these,  the lookup processes keep their own copies.
+    #verify_nameservers sends each nameserver's wildcards along with it.
+    wildcards = {}
+    #A dict only remembers spidered hosts,  a bloom filter is small enough to remember every queued host.
+    spider_blacklist = seen_set(bloom_capacity, bloom_error_rate, shared = True)
+    remember_all = isinstance(spider_blacklist, bloom_filter)
+    reported = {}
+    #Created before the lookup processes start,  they only read it.
+    answers = answer_cache(answer_file) if answer_file else None
     in_q = multiprocessing.Queue()
     out_q = multiprocessing.Queue()
-    #have a buffer of at most two new nameservers that lookup processes can draw from.
-    resolve_q = multiprocessing.Queue(maxsize = 2)
+    #Every lookup process can draw its first nameserver without waiting on the others,
+    #the rest stay ranked in verify_nameservers until they are asked for.
+    resolve_q = multiprocessing.Queue(maxsize = process_count)
 
     #Make a source of fast nameservers avaiable for other processes.
     verify_nameservers_proc = verify_nameservers(target, record_type, resolve_q, resolve_list, wildcards)
     verify_nameservers_proc.start()
+    #Lookups that have not been answered yet.
+    outstanding = 0
+    #The wordlist is streamed from disk,  only window lookups are queued or in flight at once.
+    #It is refilled as results come back,  so memory stays flat no matter how long the list is.
+    if not window:
+        window = process_count * batch_size * 4
     #The empty string 
-    in_q.put((target, record_type))
+    in_q.put([(target, record_type)])
     spider_blacklist[target]=None
-    #A list of subdomains is the input
-    for s in subdomains:
-        s = str(s).strip()
-        if s:
-            if s.find(","):
-                #SubBrute should be forgiving, a comma will never be in a url
-                #but the user might try an use a CSV file as input.
-                s=s.split(",")[0]
-            if not s.endswith(target):
-                hostname = "%s.%s" % (s, target)
-            else:
-                #A user might feed an output list as a subdomain list.
-                hostname = s
-            if hostname not in spider_blacklist:
-                spider_blacklist[hostname]=None
-                work = (hostname, record_type)
-                in_q.put(work)
-    #Terminate the queue
-    in_q.put(False)
+    outstanding += 1
+    work_done = False
+    #Workers read a compiled wordlist themselves,  the queue only carries ("shard", start, end, record_type).
+    #The scheduler has to see every candidate to recurse or spend a budget,  so then it reads the list itself.
+    wordlist_file = None
+    next_shard = 0
+    if isinstance(subdomains, compiled_wordlist) and not recursive and not budget:
+        wordlist_file = subdomains.file_name
+        work = brute_scheduler(target, record_type, None, hosts, include_target = False)
+    else:
+        work = brute_scheduler(target, record_type, subdomains_file, hosts, recursive, max_depth, budget, include_target = False)
     for i in range(process_count):
-        worker = lookup(in_q, out_q, resolve_q, target, wildcards, spider_blacklist)
+        worker = lookup(in_q, out_q, resolve_q, target, batch_size, flush_interval, wordlist_file, spider_blacklist if remember_all else None, None, answer_file)
         worker.start()
     threads_remaining = process_count
+    terminated = False
     while True:
+        #The scheduler can gain branches from any result,  so it is only done when nothing is outstanding.
+        work_done = False
+        while not work_done and outstanding < window:
+            #Without a bloom filter only spidered hosts are remembered,  a wordlist that repeats itself costs a lookup not memory.
+            batch = list(itertools.islice(iter(work), batch_size))
+            if batch:
+                if remember_all:
+                    batch = [w for w in batch if not spider_blacklist.add(w[0])]
+                else:
+                    batch = [w for w in batch if w[0] not in spider_blacklist]
+                if batch:
+                    in_q.put(batch)
+                    outstanding += len(batch)
+            elif wordlist_file and next_shard < len(subdomains):
+                end = min(next_shard + batch_size, len(subdomains))
+                in_q.put(("shard", next_shard, end, record_type))
+                outstanding += end - next_shard
+                next_shard = end
+            else:
+                work_done = True
         try:
-            #The output is valid hostnames
-            result = out_q.get(True, 10)
+            messages = out_q.get(True, 10)
             #we will get an empty exception before this runs. 
-            if not result:
+            if not messages:
                 threads_remaining -= 1
-            else:
-                #run() is a generator, and yields results from the work queue
-                yield result
+                messages = []
+            spidered = []
+            for message in messages:
+                if message[0] == "spider":
+                    (kind, hostname, spider_type) = message
+                    #A worker reports a spidered host before it answers the lookup that found it,
+                    #so this lookup is still outstanding and the end marker can't have been sent.
+                    if hostname not in spider_blacklist:
+                        spider_blacklist[hostname]=None
+                        spidered.append((hostname, spider_type, 0))
+                else:
+                    (kind, hostname, result_type, found_addresses, answer) = message
+                    outstanding -= 1
+                    if answers and answer:
+                        answers.put(hostname, result_type, *answer)
+                    #A spidered host can also come up in the wordlist,  report it once.
+                    if found_addresses is not None and hostname not in reported:
+                        reported[hostname] = None
+                        work.found(hostname)
+                        #run() is a generator, and yields results from the work queue
+                        yield (hostname, result_type, found_addresses)
+            if spidered:
+                #Spidered hosts are few, send them on right away.
+                in_q.put(spidered)
+                outstanding += len(spidered)
         except Exception as e:
             #The cx_freeze version uses queue.Empty instead of Queue.Empty :(
             if type(e) == Queue.Empty or str(type(e)) == "<class 'queue.Empty'>":
                 pass
             else:
                 raise(e)
+        if outstanding <= 0 and work_done and not terminated:
+            #Terminate the queue
+            in_q.put(False)
+            terminated = True
         #make sure everyone is complete
         if threads_remaining <= 0:
             break
@@ -492,6 +1833,494 @@ def run(target, record_type = None, subdomains = "names.txt", resolve_list = "re
     except:
         #Windows threading.tread
         verify_nameservers_proc.end()
+    if answers:
+        answers.close()
+    trace("End")
+
+#The target a hostname belongs to,  the longest one it ends with.
+def target_of(hostname, targets):
+    name = hostname
+    while name not in targets:
+        if "." not in name:
+            return None
+        name = name.split(".", 1)[1]
+    return name
+
+#Look up random names under host,  every address they resolve to is a wildcard.
+#Geolocation-aware wildcards give different answers,  so keep asking until nothing new turns up.
+#Returns the wildcards,  or None if this resolver can't tell us.
+def probe_wildcards(resolver, host, record_type = None, rounds = 8):
+    #Do we need wildcards for other types of records?
+    if record_type != "AAAA":
+        record_type = "A"
+    wildcards = {}
+    for i in range(rounds):
+        try:
+            answer = resolver.query("%s.%s" % (uuid.uuid4().hex, host), record_type)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return list(wildcards)
+        except Exception as e:
+            trace("wildcard exception:", host, resolver.nameservers, type(e))
+            return None
+        new = False
+        for w in answer:
+            w = str(w)
+            if w not in wildcards:
+                wildcards[w] = None
+                new = True
+        if not new:
+            return list(wildcards)
+    return list(wildcards)
+
+#What run_targets() knows about one target.
+class target_state(object):
+    __slots__ = ["name", "work", "outstanding", "wildcards", "probes", "done"]
+
+    def __init__(self, name, work):
+        self.name = name
+        self.work = work
+        self.outstanding = 0
+        #None until a lookup process has probed them.
+        self.wildcards = None
+        self.probes = 0
+        self.done = False
+
+#Brute force many targets with one resolver pool and one set of lookup processes.
+#Resolvers are vetted and processes started once,  not per target,  and the targets'
+#lookups are interleaved so a slow or small target never leaves the pool idle.
+#Each target's wildcards are probed by a lookup process before its wordlist starts,
+#and results are checked against that target's wildcards only.
+#Yields (target, hostname, record_type, addresses),  and (target, None, None, None)
+#once a target is finished.  hosts may be a dict of extra candidates per target.
+def run_targets(targets, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", process_count = 16, batch_size = 64, flush_interval = 0.25, window = 0, hosts = None, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None):
+    resolve_list = check_open(resolve_list)
+    if (len(resolve_list) / 16) < process_count:
+        sys.stderr.write('Warning: Fewer than 16 resovlers per thread, consider adding more nameservers to resolvers.txt.\n')
+    states = {}
+    for target in targets:
+        target = str(target).strip().lower().rstrip(".")
+        if target and target not in states:
+            states[target] = target_state(target, brute_scheduler(target, record_type, subdomains, (hosts or {}).get(target), recursive, max_depth, budget))
+    if not states:
+        return
+    spider_blacklist = seen_set(bloom_capacity, bloom_error_rate, shared = True)
+    remember_all = isinstance(spider_blacklist, bloom_filter)
+    reported = {}
+    answers = answer_cache(answer_file) if answer_file else None
+    in_q = multiprocessing.Queue()
+    out_q = multiprocessing.Queue()
+    resolve_q = multiprocessing.Queue(maxsize = process_count)
+    #Resolvers are vetted against the first target,  the wildcards found with them are not used.
+    verify_nameservers_proc = verify_nameservers(sorted(states)[0], record_type, resolve_q, resolve_list, {})
+    verify_nameservers_proc.start()
+    if not window:
+        window = process_count * batch_size * 4
+    outstanding = 0
+    for state in states.values():
+        in_q.put(("wildcards", state.name, record_type))
+        outstanding += 1
+    #Targets whose wordlists are being fed,  taken in turn.
+    rotation = collections.deque()
+    in_rotation = {}
+    for i in range(process_count):
+        worker = lookup(in_q, out_q, resolve_q, None, batch_size, flush_interval, None, spider_blacklist if remember_all else None, states, answer_file)
+        worker.start()
+    threads_remaining = process_count
+    terminated = False
+    finished = 0
+    while True:
+        while rotation and outstanding < window:
+            state = rotation[0]
+            rotation.rotate(-1)
+            batch = list(itertools.islice(iter(state.work), batch_size))
+            if not batch:
+                rotation.remove(state)
+                del in_rotation[state.name]
+                if not state.outstanding:
+                    state.done = True
+                    finished += 1
+                    yield (state.name, None, None, None)
+                continue
+            if remember_all:
+                batch = [w for w in batch if not spider_blacklist.add(w[0])]
+            else:
+                batch = [w for w in batch if w[0] not in spider_blacklist]
+            if batch:
+                in_q.put(batch)
+                #Counted against the target the host belongs to,  which is how its result is counted
+                #when one target is a subdomain of another.
+                for w in batch:
+                    states[target_of(w[0], states)].outstanding += 1
+                outstanding += len(batch)
+        if finished == len(states) and not terminated:
+            #Terminate the queue
+            in_q.put(False)
+            terminated = True
+        try:
+            messages = out_q.get(True, 10)
+            if not messages:
+                threads_remaining -= 1
+                messages = []
+            spidered = []
+            for message in messages:
+                if message[0] == "wildcards":
+                    (kind, target, wildcards) = message
+                    outstanding -= 1
+                    state = states[target]
+                    state.probes += 1
+                    if wildcards is None and state.probes < 3:
+                        in_q.put(("wildcards", target, record_type))
+                        outstanding += 1
+                        continue
+                    if wildcards is None:
+                        sys.stderr.write("Warning: Could not check %s for wildcards.\n" % target)
+                    elif wildcards:
+                        trace("Wildcards for", target, ":", wildcards)
+                    state.wildcards = dict((w, None) for w in wildcards or [])
+                    rotation.append(state)
+                    in_rotation[target] = None
+                elif message[0] == "spider":
+                    (kind, hostname, spider_type) = message
+                    state = states.get(target_of(hostname, states))
+                    if state and not state.done and hostname not in spider_blacklist:
+                        spider_blacklist[hostname]=None
+                        spidered.append((hostname, spider_type, 0))
+                        state.outstanding += 1
+                else:
+                    (kind, hostname, result_type, found_addresses, answer) = message
+                    outstanding -= 1
+                    if answers and answer:
+                        answers.put(hostname, result_type, *answer)
+                    state = states[target_of(hostname, states)]
+                    state.outstanding -= 1
+                    if found_addresses is not None and hostname not in reported:
+                        reported[hostname] = None
+                        if [a for a in found_addresses if a in state.wildcards]:
+                            trace("resovled wildcard:", hostname)
+                        else:
+                            state.work.found(hostname)
+                            yield (state.name, hostname, result_type, found_addresses)
+                    #It may have more work now,  or be finished.
+                    if state.name not in in_rotation:
+                        rotation.append(state)
+                        in_rotation[state.name] = None
+            if spidered:
+                in_q.put(spidered)
+                outstanding += len(spidered)
+        except Exception as e:
+            #The cx_freeze version uses queue.Empty instead of Queue.Empty :(
+            if type(e) == Queue.Empty or str(type(e)) == "<class 'queue.Empty'>":
+                pass
+            else:
+                raise(e)
+        #make sure everyone is complete
+        if threads_remaining <= 0:
+            break
+    for state in states.values():
+        if not state.done:
+            #The lookup processes ran out of nameservers.
+            yield (state.name, None, None, None)
+    try:
+        killproc(pid = verify_nameservers_proc.pid)
+    except:
+        #Windows threading.tread
+        verify_nameservers_proc.end()
+    if answers:
+        answers.close()
+    trace("End")
+
+#Labels that permutations() adds to and swaps between hosts,  the usual environment names.
+permutation_words = ["dev", "development", "staging", "stage", "stg", "test", "qa", "uat", "prod", "preprod",
+                     "int", "internal", "api", "admin", "beta", "demo", "old", "new", "v1", "v2"]
+number_match = re.compile(r"[0-9]+")
+
+#Derive new candidates from hosts that are already known to exist.
+#Live hosts come in families,  so a candidate built from one is far more likely to resolve
+#than a generic wordlist entry.  The cheapest, most productive rules run first:
+#number increments (api2 -> api3),  environment suffixes (api -> api-dev, api-dev -> api-staging),
+#environment labels inserted as a new level (dev.api),  then known labels swapped between levels.
+#Candidates are generated lazily and each is yielded once,  found hosts are never repeated.
+def permutations(target, found_hosts, words = None, limit = 0):
+    if words is None:
+        words = permutation_words
+    target = target.lower().rstrip(".")
+    seen = {}
+    subs = []
+    known = {}
+    for h in found_hosts:
+        #print_target() results may be "hostname,address,..."
+        h = str(h).split(",")[0].strip().lower().rstrip(".")
+        if h.endswith("." + target):
+            sub = h[:-len(target) - 1]
+            if sub and sub not in seen:
+                seen[sub] = None
+                subs.append(sub.split("."))
+                for label in sub.split("."):
+                    known[label] = None
+    count = 0
+    for rule in (permute_numbers(subs), permute_suffixes(subs, words), permute_insertions(subs, words), permute_swaps(subs, list(known))):
+        for labels in rule:
+            candidate = ".".join(labels)
+            if candidate in seen or not compiled_wordlist.label_match.match(candidate):
+                continue
+            seen[candidate] = None
+            yield "%s.%s" % (candidate, target)
+            count += 1
+            if limit and count >= limit:
+                return
+
+def permute_numbers(subs):
+    for labels in subs:
+        for (i, label) in enumerate(labels):
+            for m in number_match.finditer(label):
+                n = int(m.group())
+                for d in (1, -1, 2, -2, 3, -3):
+                    if n + d < 0:
+                        continue
+                    #Keep zero padding,  web01 -> web02.
+                    number = str(n + d).zfill(len(m.group()))
+                    yield labels[:i] + [label[:m.start()] + number + label[m.end():]] + labels[i + 1:]
+
+def permute_suffixes(subs, words):
+    for labels in subs:
+        for (i, label) in enumerate(labels):
+            parts = label.split("-")
+            if len(parts) > 1 and parts[-1] in words:
+                #api-dev -> api,  api-staging...
+                yield labels[:i] + ["-".join(parts[:-1])] + labels[i + 1:]
+                for w in words:
+                    yield labels[:i] + ["-".join(parts[:-1] + [w])] + labels[i + 1:]
+            else:
+                for w in words:
+                    yield labels[:i] + [label + "-" + w] + labels[i + 1:]
+                    yield labels[:i] + [w + "-" + label] + labels[i + 1:]
+
+def permute_insertions(subs, words):
+    for labels in subs:
+        for i in range(len(labels) + 1):
+            for w in words:
+                yield labels[:i] + [w] + labels[i:]
+
+def permute_swaps(subs, known):
+    for labels in subs:
+        for i in range(len(labels)):
+            for k in known:
+                yield labels[:i] + [k] + labels[i + 1:]
+
+#Where the scheduler draws candidates from: the wordlist under one domain,
+#or a generator of hostnames such as permutations().
+class brute_branch(object):
+    __slots__ = ["name", "depth", "position", "source", "issued", "hits", "version", "done"]
+
+    def __init__(self, name, depth = 0, source = None):
+        self.name = name
+        self.depth = depth
+        self.position = 0
+        self.source = source
+        self.issued = 0
+        self.hits = 0
+        self.version = 0
+        self.done = False
+
+#Decides what to look up next.  Iterating it yields (hostname, record_type) lazily,
+#taking the next candidate from the branch with the best hit rate so far.
+#A generic wordlist misses most of the time,  a branch that is finding hosts
+#(permutations, a busy subdomain) gets the queries first.
+#With recursive = True every host found becomes a new branch and the wordlist is
+#brute forced under it too,  down to max_depth labels below the target.
+#budget caps the number of candidates handed out.
+#The engines call found() with each result so the hit rates stay current.
+#Iterating again after it runs dry picks up branches added since.
+class brute_scheduler(object):
+    #A new branch is assumed to hit 1 in 10 until it has been tried.
+    prior_hits = 1.0
+    prior_tries = 10.0
+    #A branch that answers almost everything is a wildcard the resolvers didn't catch.
+    wildcard_tries = 50
+    wildcard_rate = 0.9
+
+    def __init__(self, target, record_type, subdomains = None, hosts = None, recursive = False, max_depth = 2, budget = 0, include_target = True):
+        self.target = target
+        self.record_type = record_type
+        self.recursive = recursive
+        self.max_depth = max_depth
+        self.budget = budget
+        self.issued = 0
+        self.heap = []
+        self.sequence = itertools.count()
+        self.branches = {}
+        #Hosts handed out by a generator branch,  so their hits can be counted.
+        self.sourced = {}
+        self.first = collections.deque([target] if include_target else [])
+        self.wordlist = None
+        #The branch whose line the plain wordlist file is positioned after.
+        self.file_branch = None
+        if subdomains:
+            self.wordlist = open_wordlist(subdomains)
+            if not isinstance(self.wordlist, compiled_wordlist):
+                #Each branch keeps its own offset into the one file handle.
+                self.wordlist = open(subdomains, "rb")
+            self.add_branch(brute_branch(target))
+        if hosts is not None:
+            self.push(brute_branch(None, 0, iter(hosts)))
+
+    def add_branch(self, branch):
+        self.branches[branch.name] = branch
+        self.push(branch)
+
+    def push(self, branch):
+        rate = (branch.hits + self.prior_hits) / (branch.issued + self.prior_tries)
+        heapq.heappush(self.heap, (-rate, next(self.sequence), branch.version, branch))
+
+    def next_host(self, branch):
+        if branch.source is not None:
+            for h in branch.source:
+                return h
+            return None
+        if isinstance(self.wordlist, compiled_wordlist):
+            if branch.position >= len(self.wordlist):
+                return None
+            branch.position += 1
+            return "%s.%s" % (self.wordlist[branch.position - 1], branch.name)
+        if self.file_branch is not branch:
+            self.wordlist.seek(branch.position)
+            self.file_branch = branch
+        while True:
+            line = self.wordlist.readline()
+            if not line:
+                return None
+            branch.position = self.wordlist.tell()
+            s = line.decode("latin-1").strip()
+            if not s:
+                continue
+            #SubBrute should be forgiving, a comma will never be in a url
+            #but the user might try an use a CSV file as input.
+            s = s.split(",")[0]
+            if s.endswith(self.target):
+                #A user might feed an output list as a subdomain list.
+                if branch.name == self.target:
+                    return s
+                continue
+            return "%s.%s" % (s, branch.name)
+
+    def __iter__(self):
+        while self.first:
+            self.issued += 1
+            yield (self.first.popleft(), self.record_type)
+        while self.heap:
+            if self.budget and self.issued >= self.budget:
+                trace("Query budget spent:", self.budget)
+                self.heap = []
+                return
+            (score, sequence, version, branch) = heapq.heappop(self.heap)
+            if branch.done or version != branch.version:
+                continue
+            host = self.next_host(branch)
+            if host is None:
+                branch.done = True
+                continue
+            branch.issued += 1
+            self.issued += 1
+            if branch.source is not None:
+                self.sourced[host] = branch
+            self.push(branch)
+            yield (host, self.record_type)
+
+    def found(self, hostname):
+        branch = self.sourced.pop(hostname, None)
+        if branch is None:
+            #The closest enclosing domain that is being brute forced.
+            name = hostname
+            while "." in name and branch is None:
+                name = name.split(".", 1)[1]
+                branch = self.branches.get(name)
+        if branch is not None:
+            branch.hits += 1
+            if branch.depth and branch.issued >= self.wildcard_tries and branch.hits > branch.issued * self.wildcard_rate:
+                trace("Dropping branch that looks like a wildcard:", branch.name)
+                branch.done = True
+            elif not branch.done:
+                #Move it up the queue now rather than when its old score comes up.
+                branch.version += 1
+                self.push(branch)
+        if self.recursive and self.wordlist and hostname not in self.branches and hostname.endswith("." + self.target):
+            depth = hostname[:-len(self.target) - 1].count(".") + 1
+            if depth < self.max_depth:
+                trace("Brute forcing under:", hostname)
+                self.add_branch(brute_branch(hostname, depth))
+
+def run_async(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", concurrency = 1000, timeout = 2, hosts = None, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None, resolver_rate = 0):
+    if asyncio is None:
+        error("The async engine requires Python 3.4 or later, use the process engine.")
+    resolve_list = check_open(resolve_list)
+    #Everything lives in this process,  no Manager proxies needed.
+    wildcards = {}
+    spider_blacklist = seen_set(bloom_capacity, bloom_error_rate)
+    #The engine drains this as fast as resolvers are vetted, they arrive fastest first.
+    resolve_q = Queue.Queue(maxsize = 64)
+    #Nameservers are verified in a thread, they are handed over as soon as their wildcards are known.
+    verify_nameservers_proc = verify_nameservers(target, record_type, resolve_q, resolve_list, wildcards)
+    verify_thread = threading.Thread(target = verify_nameservers_proc.run)
+    verify_thread.daemon = True
+    verify_thread.start()
+    work = brute_scheduler(target, record_type, subdomains, hosts, recursive, max_depth, budget)
+    loop = asyncio.new_event_loop()
+    answers = answer_cache(answer_file) if answer_file else None
+    engine = async_lookup(loop, target, work, resolve_q, wildcards, spider_blacklist, concurrency, timeout, answers, resolver_rate)
+    transport = None
+    try:
+        transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(lambda: engine, family = socket.AF_INET))
+        try:
+            #Replies arrive in bursts,  a small receive buffer silently drops them.
+            transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except Exception:
+            pass
+        engine.start()
+        while True:
+            loop.run_until_complete(engine.wait())
+            #run_async() is a generator, just like run()
+            while engine.results:
+                yield engine.results.popleft()
+            if engine.finished:
+                break
+    finally:
+        #We no longer require name servers.
+        verify_nameservers_proc.end()
+        if transport:
+            transport.close()
+        loop.close()
+        if answers:
+            trace("answer cache hits:", answers.hits, "misses:", answers.misses)
+            answers.close()
+    trace("End")
+
+def run_blast(target, record_type = None, subdomains = "names.txt", resolve_list = "resolvers.txt", concurrency = 10000, timeout = 2, hosts = None, bloom_capacity = 0, bloom_error_rate = 0.001, recursive = False, max_depth = 2, budget = 0, answer_file = None, resolver_rate = 0):
+    resolve_list = check_open(resolve_list)
+    wildcards = {}
+    spider_blacklist = seen_set(bloom_capacity, bloom_error_rate)
+    #The engine drains this as fast as resolvers are vetted, they arrive fastest first.
+    resolve_q = Queue.Queue(maxsize = 64)
+    #Nameservers are verified in a thread, they are handed over as soon as their wildcards are known.
+    verify_nameservers_proc = verify_nameservers(target, record_type, resolve_q, resolve_list, wildcards)
+    verify_thread = threading.Thread(target = verify_nameservers_proc.run)
+    verify_thread.daemon = True
+    verify_thread.start()
+    work = brute_scheduler(target, record_type, subdomains, hosts, recursive, max_depth, budget)
+    answers = answer_cache(answer_file) if answer_file else None
+    engine = blast_lookup(target, record_type, work, resolve_q, wildcards, spider_blacklist, concurrency, timeout, answers = answers, max_rate = resolver_rate)
+    try:
+        while not engine.finished:
+            engine.step()
+            #run_blast() is a generator, just like run()
+            while engine.results:
+                yield engine.results.popleft()
+    finally:
+        #We no longer require name servers.
+        verify_nameservers_proc.end()
+        engine.close()
+        if answers:
+            trace("answer cache hits:", answers.hits, "misses:", answers.misses)
+            answers.close()
     trace("End")
 
 #exit handler for signals.  So ctrl+c will work. 
@@ -538,6 +2367,182 @@ def check_open(input_file):
         error("File is empty:", input_file)
     return ret
 
+#Wordlists can be millions of lines,  read them a line at a time rather than with check_open().
+#A compiled wordlist is memory mapped instead,  see compile_wordlist().
+def open_wordlist(input_file):
+    try:
+        wordlist = open(input_file, "rb")
+    except:
+        error("File not found:", input_file)
+    first = wordlist.readline()
+    if not first:
+        error("File is empty:", input_file)
+    if first.startswith(compiled_wordlist.magic):
+        wordlist.close()
+        return compiled_wordlist(input_file)
+    wordlist.close()
+    wordlist = open(input_file)
+    return itertools.chain([wordlist.readline()], wordlist)
+
+#A compiled wordlist is built once with --compile, then every run memory maps it.
+#The layout is a header,  an index of label offsets,  and the labels back to back:
+#  magic | label count | offsets[count + 1] (uint32) | labels
+#Labels are deduplicated,  lower case,  valid DNS names,  and sorted by frequency.
+#Each lookup process maps the same file,  so the pages are shared and the parent
+#only has to send index ranges rather than every label.
+class compiled_wordlist(object):
+    magic = b"SUBBRUTE-WORDLIST-1\n"
+    header = struct.Struct("<I")
+    offset = struct.Struct("<I")
+    label_match = re.compile(r"^[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?(\.[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?)*$")
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.wordlist = open(file_name, "rb")
+        self.map = mmap.mmap(self.wordlist.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.map[:len(self.magic)] != self.magic:
+            error("Not a compiled wordlist:", file_name)
+        (self.count,) = self.header.unpack_from(self.map, len(self.magic))
+        self.index = len(self.magic) + self.header.size
+        self.labels = self.index + (self.count + 1) * self.offset.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        (start,) = self.offset.unpack_from(self.map, self.index + i * self.offset.size)
+        (end,) = self.offset.unpack_from(self.map, self.index + (i + 1) * self.offset.size)
+        return self.map[self.labels + start:self.labels + end].decode("ascii")
+
+    def __iter__(self):
+        return self.shard(0, self.count)
+
+    #Labels [start, end), read straight out of the mapping.
+    def shard(self, start, end):
+        end = min(end, self.count)
+        if start >= end:
+            return
+        offsets = struct.unpack_from("<%dI" % (end - start + 1), self.map, self.index + start * self.offset.size)
+        for i in range(end - start):
+            yield self.map[self.labels + offsets[i]:self.labels + offsets[i + 1]].decode("ascii")
+
+    #Hostnames under the target,  labels were validated at compile time.
+    def hosts(self, target, start = 0, end = None):
+        if end is None:
+            end = self.count
+        for label in self.shard(start, end):
+            yield "%s.%s" % (label, target)
+
+    def close(self):
+        self.map.close()
+        self.wordlist.close()
+
+#Build a compiled wordlist from a plain one,  returns the number of labels written.
+#A line may be "label" or "label,count".  Plain lists like names.txt are already sorted
+#by frequency so their order is kept,  counts (as written by -f) add up and sort first.
+def compile_wordlist(input_file, output_file):
+    counts = {}
+    order = {}
+    for line in open_wordlist(input_file):
+        line = str(line).strip()
+        if not line:
+            continue
+        fields = line.split(",")
+        label = fields[0].strip().lower().rstrip(".")
+        if not compiled_wordlist.label_match.match(label) or len(label) > 200:
+            trace("Skipping invalid label:", label)
+            continue
+        try:
+            count = int(fields[1])
+        except (IndexError, ValueError):
+            count = 0
+        if label in counts:
+            counts[label] += count
+        else:
+            counts[label] = count
+            order[label] = len(order)
+    #Most frequent first,  ties keep the order of the input.
+    labels = sorted(counts, key = lambda x: (-counts[x], order[x]))
+    del order
+    offsets = array.array("I", [0])
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(compiled_wordlist.magic)
+        f.write(compiled_wordlist.header.pack(len(labels)))
+        #The index is written after the labels are measured,  leave room for it.
+        index_pos = f.tell()
+        f.write(b"\x00" * (compiled_wordlist.offset.size * (len(labels) + 1)))
+        for label in labels:
+            label = label.encode("ascii")
+            f.write(label)
+            offsets.append(offsets[-1] + len(label))
+        f.seek(index_pos)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        f.write(offsets.tobytes() if hasattr(offsets, "tobytes") else offsets.tostring())
+    getattr(os, "replace", os.rename)(tmp_file, output_file)
+    return len(labels)
+
+#A compact "have we queued this host?" set for runs with tens of millions of candidates.
+#A dict costs ~100 bytes per hostname,  this costs ~1.8 bytes at a 0.1% false positive rate.
+#A false positive means a host is skipped,  never that a host is reported that doesn't exist.
+#It is used like the dicts it replaces:  "host in seen" and "seen[host] = None".
+#With shared = True the bits live in shared memory so the lookup processes can read them,
+#only the process that created it should write.
+class bloom_filter(object):
+    def __init__(self, capacity, error_rate = 0.001, shared = False):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / float(capacity) * math.log(2))))
+        size = (self.bit_count + 7) // 8
+        if shared:
+            self.bits = multiprocessing.RawArray("B", size)
+        else:
+            self.bits = bytearray(size)
+        self.count = 0
+
+    #Double hashing,  k bit positions from the two halves of one md5.
+    def positions(self, key):
+        (a, b) = struct.unpack("<QQ", hashlib.md5(key.encode("utf-8")).digest())
+        m = self.bit_count
+        return [(a + i * b) % m for i in range(self.hash_count)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] >> (p & 7) & 1:
+                return False
+        return True
+
+    #Returns True if the key was (probably) already present.
+    def add(self, key):
+        bits = self.bits
+        present = True
+        for p in self.positions(key):
+            byte = bits[p >> 3]
+            bit = 1 << (p & 7)
+            if not byte & bit:
+                bits[p >> 3] = byte | bit
+                present = False
+        if not present:
+            self.count += 1
+            if self.count == self.capacity + 1:
+                trace("Bloom filter over capacity,  false positives will rise above", self.error_rate)
+        return present
+
+    def __setitem__(self, key, value):
+        self.add(key)
+
+    def __len__(self):
+        return self.count
+
+#The set of queued hostnames,  a dict unless a bloom filter capacity is given.
+def seen_set(bloom_capacity = 0, bloom_error_rate = 0.001, shared = False):
+    if bloom_capacity:
+        return bloom_filter(bloom_capacity, bloom_error_rate, shared)
+    return {}
+
 #Every 'multiprocessing' process needs a signal handler.
 #All processes need to die, we don't want to leave zombies.
 def signal_init():
@@ -573,23 +2578,70 @@ if __name__ == "__main__":
               type = "string", help = "(optional) Print all reponses for an arbitrary DNS record type (CNAME, AAAA, TXT, SOA, MX...)")                  
     parser.add_option("-c", "--process_count", dest = "process_count",
               default = 16, type = "int",
-              help = "(optional) Number of lookup theads to run. default = 16")
+              help = "(optional) Number of lookup theads to run with the process engine,  or of processes for -f. default = 16")
+    parser.add_option("--concurrency", dest = "concurrency",
+              default = 1000, type = "int",
+              help = "(optional) Number of queries in flight with the async and blast engines. default = 1000")
+    parser.add_option("--rate", dest = "rate",
+              default = 0, type = "float",
+              help = "(optional) Most queries a second to send each resolver with the async and blast engines,  they are also paced to what each resolver sustains. default = no limit")
+    parser.add_option("--timeout", dest = "timeout",
+              default = 2, type = "float",
+              help = "(optional) Seconds to wait for a reply with the async and blast engines. default = 2")
+    parser.add_option("--resolver_cache", dest = "resolver_cache", default = resolver_cache_file,
+              type = "string", help = "(optional) File to remember resolver health in between runs, an empty string disables it. default = '~/.subbrute/resolver_cache.json'")
+    parser.add_option("--resolver_cache_ttl", dest = "resolver_cache_ttl", default = resolver_cache_ttl,
+              type = "int", help = "(optional) Seconds before a cached resolver is vetted again. default = 3600")
+    parser.add_option("--cache", dest = "cache", default = "",
+              type = "string", help = "(optional) Remember answers and NXDOMAINs in this sqlite file for their TTL,  a repeat scan only asks about names that expired. default = off")
+    parser.add_option("-e", "--engine", dest = "engine", default = "process",
+              type = "choice", choices = engines,
+              help = "(optional) Brute force engine, 'process', 'async' (single process, thousands of queries in flight) or 'blast' (stateless, for very large wordlists). default = 'process'")
     parser.add_option("-f", "--filter_subs", dest = "filter", default = "",
               type = "string", help = "(optional) A file containing unorganized domain names which will be filtered into a list of subdomains sorted by frequency.  This was used to build names.txt.")                 
+    parser.add_option("--bloom", dest = "bloom", default = 0, type = "int",
+              help = "(optional) Remember queued hosts in a bloom filter sized for this many names,  ~2 bytes per name instead of ~100.  A false positive skips a host. default = off")
+    parser.add_option("--bloom_error", dest = "bloom_error", default = 0.001, type = "float",
+              help = "(optional) False positive rate of the --bloom filter. default = 0.001")
+    parser.add_option("-R", "--recursive", action = 'store_true', dest = "recursive", default = False,
+              help = "(optional) Also brute force under every subdomain found, busiest branches first.")
+    parser.add_option("--depth", dest = "depth", default = 2, type = "int",
+              help = "(optional) With -R, the most labels below the target to brute force. default = 2")
+    parser.add_option("--budget", dest = "budget", default = 0, type = "int",
+              help = "(optional) Stop after this many candidates have been looked up, the most productive first. default = no limit")
+    parser.add_option("-p", "--permute", dest = "permute", default = "",
+              type = "string", help = "(optional) A file of known hostnames,  permutations of them (api2 -> api3, api -> api-dev, dev.api...) are tried before the wordlist.")
+    parser.add_option("--counts", action = 'store_true', dest = "counts", default = False,
+              help = "(optional) With -f, print 'subdomain,count' so the counts can be merged into later runs with --merge.")
+    parser.add_option("--merge", dest = "merge", default = "",
+              type = "string", help = "(optional) With -f, add the new counts to this existing wordlist.  Implies --counts.")
+    parser.add_option("--compile", dest = "compile", default = "",
+              type = "string", help = "(optional) Compile the -s wordlist into this file,  a deduplicated and memory mapped list that loads instantly. Pass the compiled file to -s on later runs.")
     parser.add_option("-v", "--verbose", action = 'store_true', dest = "verbose", default = False,
               help = "(optional) Print debug information.")
     (options, args) = parser.parse_args()
 
     
     verbose = options.verbose
+    resolver_cache_file = options.resolver_cache
+    resolver_cache_ttl = options.resolver_cache_ttl
 
-    if len(args) < 1 and options.filter == "" and options.targets == "":
+    if len(args) < 1 and options.filter == "" and options.targets == "" and options.compile == "":
         parser.error("You must provie a target. Use -h for help.")
 
     if options.filter != "":
         #cleanup this file and print it out
-        for d in extract_subdomains(options.filter):
-            print(d)
+        if options.counts or options.merge:
+            for (d, count) in extract_subdomains(options.filter, options.process_count, options.merge, True):
+                print("%s,%d" % (d, count))
+        else:
+            for d in extract_subdomains(options.filter, options.process_count):
+                print(d)
+        sys.exit()
+
+    if options.compile != "":
+        count = compile_wordlist(options.subs, options.compile)
+        sys.stderr.write("Compiled %d labels into %s\n" % (count, options.compile))
         sys.exit()
 
     if options.targets != "":
@@ -617,6 +2669,15 @@ if __name__ == "__main__":
     if options.type:
         record_type = str(options.type).upper()
 
+    found_subdomains = []
+    if options.permute:
+        found_subdomains = check_open(options.permute)
+    targets = [t.strip() for t in targets if t.strip()]
+    if options.engine == "process" and len(targets) > 1:
+        #One resolver pool and one set of lookup processes for every target.
+        print_targets(targets, record_type, options.subs, options.resolvers, options.process_count, output, json_output, found_subdomains, permute = bool(options.permute), bloom_capacity = options.bloom, bloom_error_rate = options.bloom_error, recursive = options.recursive, max_depth = options.depth, budget = options.budget, answer_file = options.cache or None)
+        targets = []
+
     threads = []
     for target in targets:
         target = target.strip()
@@ -630,6 +2691,6 @@ if __name__ == "__main__":
             #options.output
             #options.json
             print(target, record_type, options.subs, options.resolvers, options.process_count, output, json_output)
-            print_target(target, record_type, options.subs, options.resolvers, options.process_count, output, json_output)
+            print_target(target, record_type, options.subs, options.resolvers, options.process_count, output, json_output, found_subdomains, engine = options.engine, concurrency = options.concurrency, timeout = options.timeout, permute = bool(options.permute), bloom_capacity = options.bloom, bloom_error_rate = options.bloom_error, recursive = options.recursive, max_depth = options.depth, budget = options.budget, answer_file = options.cache or None, resolver_rate = options.rate)
 
 